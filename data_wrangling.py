@@ -1,13 +1,31 @@
+import os
+import glob
+import numpy as np
 import pandas as pd
 import geopandas as gpd
 from pandas.io.json import json_normalize
 import requests 
 import json
+import geometry
+import spatial
+import gtfs
+import pipeline
 
 tracts_filepath = 'data_sources/shape_tracts/tl_2018_17_tract.shp'
 places_filepath = 'data_sources/shape_places/tl_2018_17_place.shp'
 jobs_filepath = 'data_sources/il_jobs_by_tract_2017.csv'
 
+# TIGER files come one per state, so they double as partitions
+TRACTS_FILEPATH_TEMPLATE = 'data_sources/shape_tracts/tl_2018_{}_tract.shp'
+PLACES_FILEPATH_TEMPLATE = 'data_sources/shape_places/tl_2018_{}_place.shp'
+PARTITION_DIR = 'pickle_files/partitions'
+PARTITION_FILENAME_TEMPLATE = 'final_data_{}.pkl'
+# medians over all partitions, used to impute any subset of them
+PARTITION_MEDIANS_FILENAME = 'medians.pkl'
+JOBS_CHUNKSIZE = 100000
+
+LODES_CACHE_DIR = 'pickle_files/jobs'
+
 with open('CENSUS_DATA_COLS.json') as f:
     DATA_COLS = json.load(f)
 
@@ -53,7 +71,7 @@ def create_transitscore_datalist(df, api_key_index):
             json['centroid_lng'] = row.centroid_lng
             datalist.append(json)
 
-    return transitscore_datalist
+    return datalist
 
 
 def create_transitscore_dataframe(transitscore_datalist):
@@ -66,33 +84,38 @@ def create_transitscore_dataframe(transitscore_datalist):
     Returns:
         (pandas DataFrame)
     '''    
-    df = pd.DataFrame.from_dict(json_normalize(datalist), orient='columns')
+    df = pd.DataFrame.from_dict(json_normalize(transitscore_datalist), orient='columns')
     df = df[['tract_GEO_ID', 'transit_score']]
     grouped = df.groupby('tract_GEO_ID').mean()
     
     return grouped
 
 
-def tract_data(tracts_filepath, jobs_filepath):
+def tract_data(tracts_filepath, jobs_filepath, geo_prefix=None):
     '''
     Loads and cleans census tract shapefiles.
     Creates a dataframe of all data on the tract level.
+    Geometry comes from the cached sidecar (see geometry.load_sidecar):
+    centroids are computed in a projected CRS and polygons are simplified
+    for joins.
 
     Inputs:
         tracts_filepath, jobs_filepath (str)
+        geo_prefix (str): optional state or state + county FIPS code; if
+            given, only job rows for tracts starting with it are kept
     Outputs:
         (geopandas DataFrame)
     '''
-    #Loading tracts
-    tracts = gpd.read_file(tracts_filepath)
-    tracts = tracts[['GEOID', 'NAMELSAD', 'ALAND', 'geometry']] \
+    #Loading tracts from the cached geometry sidecar
+    tracts = geometry.load_sidecar(tracts_filepath, ['GEOID', 'NAMELSAD', 'ALAND'],
+                                   simplify_tolerance=geometry.JOIN_TOLERANCE)
+    tracts = tracts[['GEOID', 'NAMELSAD', 'ALAND', 'centroid_x', 'centroid_y',
+                     'centroid_lng', 'centroid_lat', 'geometry']] \
                             .rename(columns={'GEOID': 'tract_GEO_ID', 'NAMELSAD': 'tract_name',
                            'ALAND': 'tract_area'})
-    tracts['centroid_lng'] = tracts.geometry.centroid.x
-    tracts['centroid_lat'] = tracts.geometry.centroid.y
     
     #Loading jobs
-    jobs = pd.read_csv(jobs_filepath)
+    jobs = load_jobs(jobs_filepath, geo_prefix)
     jobs = jobs[['id', 'label', 'c000']] \
             .rename(columns={'id': 'job_tract_GEO_ID', 'label': 'job_tract_label',
                              'c000': 'num_jobs'})
@@ -104,16 +127,95 @@ def tract_data(tracts_filepath, jobs_filepath):
     return all_tract_data
 
 
+def load_jobs(jobs_filepath, geo_prefix=None):
+    '''
+    Reads the jobs by tract file. With a geo_prefix the file is read in
+    chunks and only the rows of that partition are kept, so memory does not
+    grow with the size of the file.
+
+    Inputs:
+        jobs_filepath (str)
+        geo_prefix (str): optional state or state + county FIPS code
+    Outputs:
+        (pandas DataFrame)
+    '''
+    if jobs_filepath.endswith('.csv.gz'):
+        jobs = load_lodes_wac(jobs_filepath)
+        if geo_prefix is not None:
+            jobs = jobs[jobs['id'].str.startswith(geo_prefix)]
+        return jobs
+
+    if geo_prefix is None:
+        return pd.read_csv(jobs_filepath)
+
+    chunks = []
+    for chunk in pd.read_csv(jobs_filepath, dtype={'id': str},
+                             chunksize=JOBS_CHUNKSIZE):
+        chunks.append(chunk[chunk['id'].str.startswith(geo_prefix)])
+
+    return pd.concat(chunks, ignore_index=True)
+
+
+def load_lodes_wac(wac_filepath, segment_cols=None, cache_dir=LODES_CACHE_DIR):
+    '''
+    Reads a raw block-level LODES WAC file in chunks and aggregates the
+    job counts to 11-digit census tracts as it goes, so memory stays flat
+    regardless of the number of blocks. The tract-level result is cached
+    to a pickle file and reused as long as the source file is unchanged.
+
+    Inputs:
+        wac_filepath (str) path to a <st>_wac_<seg>_<type>_<year>.csv.gz file
+        segment_cols (list) optional LODES segment columns (e.g. 'CE01') to
+            aggregate in addition to C000
+        cache_dir (str) directory for cached tract-level files, or None to
+            skip caching
+    Outputs:
+        (pandas DataFrame) with the columns of the pre-aggregated jobs file:
+        id, label, c000 and any lowercased segment columns
+    '''
+    cols = ['C000'] + list(segment_cols or [])
+    cache_filepath = None
+
+    if cache_dir:
+        name = os.path.basename(wac_filepath).replace('.csv.gz', '')
+        cache_filepath = os.path.join(cache_dir, '{}_{}.pkl'.format(
+            name, '_'.join(cols).lower()))
+        if os.path.exists(cache_filepath) and \
+           os.path.getmtime(cache_filepath) >= os.path.getmtime(wac_filepath):
+            return pd.read_pickle(cache_filepath)
+
+    partial_sums = []
+    for chunk in pd.read_csv(wac_filepath, usecols=['w_geocode'] + cols,
+                             dtype={'w_geocode': str},
+                             chunksize=JOBS_CHUNKSIZE * 10):
+        tract_ids = chunk['w_geocode'].str[:11]
+        partial_sums.append(chunk[cols].groupby(tract_ids).sum())
+
+    jobs = pd.concat(partial_sums).groupby(level=0).sum()
+    jobs.columns = [col.lower() for col in jobs.columns]
+    jobs.index.name = 'id'
+    jobs = jobs.reset_index()
+    jobs.insert(1, 'label', jobs['id'])
+
+    if cache_filepath:
+        os.makedirs(cache_dir, exist_ok=True)
+        jobs.to_pickle(cache_filepath)
+
+    return jobs
+
+
 def place_data(places_filepath):
     '''
-    Loads and cleans places shapefiles.
+    Loads and cleans places shapefiles. Geometry comes from the cached
+    sidecar (see geometry.load_sidecar), simplified for joins.
 
     Inputs:
         places_filepath (str)
     Outputs:
         (geopandas DataFrame)
     '''
-    places = gpd.read_file(places_filepath)
+    places = geometry.load_sidecar(places_filepath, ['GEOID', 'NAME', 'NAMELSAD'],
+                                   simplify_tolerance=geometry.JOIN_TOLERANCE)
     all_places_data = places[['GEOID', 'NAME', 'NAMELSAD', 'geometry']] \
                             .rename(columns={'GEOID': 'place_GEO_ID', 'NAME': 'place_name',
                            'NAMELSAD': 'place_name_and_type'})
@@ -148,6 +250,24 @@ def add_transitscore(all_tracts_data, all_places_data):
     return df 
 
 
+def add_transitscore_gtfs(all_tracts_data, feed_dirs):
+    '''
+    Offline alternative to add_transitscore: scores tracts from local GTFS
+    feeds (see gtfs.score_tracts) instead of querying the WalkScore API.
+
+    Inputs:
+        all_tracts_data (geopandas DataFrame)
+        feed_dirs (list of str) GTFS feed directories
+    Outputs:
+        (pandas DataFrame)
+    '''
+    service = gtfs.load_feeds(feed_dirs)
+    scores, _ = gtfs.score_tracts(all_tracts_data, service)
+    transitscore_by_tract = scores.rename_axis('tract_GEO_ID').reset_index()
+
+    return all_tracts_data.merge(transitscore_by_tract, on='tract_GEO_ID')
+
+
 def data_cleaning(df):
     '''
     Given full dataframe, calculates job density and population density,
@@ -172,7 +292,8 @@ def data_cleaning(df):
     df[df < 0] = np.nan
 
     #Drop added columns used for calculating features
-    df = df.drop(['year', 'centroid_lng', 'centroid_lat', 'tract_area', 'num_jobs'], axis=1)
+    df = df.drop(['year', 'centroid_lng', 'centroid_lat', 'centroid_x', 'centroid_y',
+                  'tract_area', 'num_jobs'], axis=1)
 
     #Drop variables from ACS used for calculting features
     keys = [key for key in list(DATA_COLS.values()) if key != 'GEO_ID']
@@ -182,7 +303,9 @@ def data_cleaning(df):
     return df
 
 
-def go(acs5, tracts_filepath, places_filepath, jobs_filepath, pickle_filename=None):
+def go(acs5, tracts_filepath, places_filepath, jobs_filepath, pickle_filename=None,
+       lag_columns=None, lag_method='queen', gtfs_feed_dirs=None,
+       job_radii=None):
     '''
     Executes all steps to take pulled ACS data to final dataframe for model 
     selection.
@@ -190,20 +313,365 @@ def go(acs5, tracts_filepath, places_filepath, jobs_filepath, pickle_filename=No
     Inputs:
         acs5 (pandas DataFrame)
         tracts_filepath, places_filepath, jobs_filepath, pickle_filename (str)
+        lag_columns (list) optional features to add spatially lagged
+            versions of (see spatial.add_spatial_lags)
+        lag_method (str) 'queen', 'rook' or 'knn' spatial weights
+        gtfs_feed_dirs (list of str) optional GTFS feed directories; if
+            given, transit scores are computed locally instead of with the
+            WalkScore API
+        job_radii (list) optional radii in meters of job accessibility
+            features to add (see spatial.add_job_accessibility)
     Outputs:
         (pandas DataFrame)
     '''
     #Prepping transitscore data and job data
+    all_tract_data = prepare_tract_data(tracts_filepath, jobs_filepath, job_radii)
+    if gtfs_feed_dirs:
+        transit_score_added = add_transitscore_gtfs(all_tract_data, gtfs_feed_dirs)
+    else:
+        all_place_data = place_data(places_filepath)
+        transit_score_added = add_transitscore(all_tract_data, all_place_data)
+
+    return finish_data(acs5, transit_score_added, tracts_filepath,
+                       pickle_filename, lag_columns, lag_method)
+
+
+def go_stages(acs5_stage, tracts_filepath, places_filepath, jobs_filepath,
+              pickle_filename=None, lag_columns=None, lag_method='queen',
+              gtfs_feed_dirs=None, job_radii=None):
+    '''
+    The steps of go as stages for stages.run_stages, so that independent
+    steps run concurrently: the tract (and job) load and the places load
+    run in processes alongside the ACS stage, transit scores are queried
+    in a thread as soon as both are loaded, and the final stage merges
+    and cleans everything as go does.
+
+    Inputs:
+        acs5_stage (tuple) stage returning the processed ACS DataFrame
+        other inputs: see go
+    Outputs:
+        (dict) stages; the result of the 'final' stage is the output of go
+    '''
+    build_stages = {
+        'acs': acs5_stage,
+        'tracts': (prepare_tract_data, (tracts_filepath, jobs_filepath, job_radii),
+                   [], 'process')}
+
+    if gtfs_feed_dirs:
+        build_stages['transit_score'] = (add_transitscore_gtfs, (gtfs_feed_dirs,),
+                                         ['tracts'], 'thread')
+    else:
+        build_stages['places'] = (place_data, (places_filepath,), [], 'process')
+        build_stages['transit_score'] = (add_transitscore, (),
+                                         ['tracts', 'places'], 'thread')
+
+    build_stages['final'] = (finish_data, (tracts_filepath, pickle_filename,
+                                           lag_columns, lag_method),
+                             ['acs', 'transit_score'], 'thread')
+
+    return build_stages
+
+
+def prepare_tract_data(tracts_filepath, jobs_filepath, job_radii=None):
+    '''
+    Loads tract and job data (see tract_data) and optionally adds job
+    accessibility features.
+
+    Inputs:
+        tracts_filepath, jobs_filepath (str)
+        job_radii (list) optional radii in meters of job accessibility
+            features to add (see spatial.add_job_accessibility)
+    Outputs:
+        (geopandas DataFrame)
+    '''
     all_tract_data = tract_data(tracts_filepath, jobs_filepath)
-    all_place_data = place_data(places_filepath)
-    transit_score_added = add_transitscore(all_tract_data, all_place_data)
+    if job_radii:
+        all_tract_data = spatial.add_job_accessibility(all_tract_data, job_radii)
+
+    return all_tract_data
+
 
+def finish_data(acs5, transit_score_added, tracts_filepath, pickle_filename=None,
+                lag_columns=None, lag_method='queen'):
+    '''
+    Merges ACS data with tract data, cleans it, optionally adds spatial
+    lags and optionally writes the result to a pickle file.
+
+    Inputs:
+        acs5 (pandas DataFrame)
+        transit_score_added (pandas DataFrame)
+        other inputs: see go
+    Outputs:
+        (pandas DataFrame)
+    '''
     #Merging all data with ACS and optionally write to pickle file
     acs5['tract_GEO_ID'] = acs5['GEO_ID'].apply(lambda x: x[9:])  
-    full_df = pd.merge(acs5, transit_score_added, on='tract_GEO_ID')
-    final_df = data_cleaning(full_df)
+    final_df = merge_and_clean(acs5, transit_score_added)
+
+    if lag_columns:
+        ids, weights = spatial.load_weights(tracts_filepath, lag_method)
+        final_df = spatial.add_spatial_lags(final_df, final_df['GEO_ID'].str[9:],
+                                            ids, weights, lag_columns)
 
     if pickle_filename:
         final_df.to_pickle(pickle_filename)
 
     return final_df
+
+
+def merge_and_clean(acs5, transit_score_added):
+    '''
+    Merges ACS data with tract, job and transit score data and cleans the
+    result.
+
+    Inputs:
+        acs5 (pandas DataFrame) with a tract_GEO_ID column
+        transit_score_added (pandas DataFrame)
+    Outputs:
+        (pandas DataFrame)
+    '''
+    full_df = pd.merge(acs5, transit_score_added, on='tract_GEO_ID')
+
+    return data_cleaning(full_df)
+
+
+def go_partitioned(acs5_loader, partitions, jobs_filepath,
+                   output_dir=PARTITION_DIR, job_radii=None):
+    '''
+    Streaming version of go. Processes one state at a time through the
+    tract/job load and the transit score join, and within a state one
+    county at a time through the ACS merge and data cleaning, writing
+    every county to its own pickle file. Peak memory is bounded by the largest partition
+    rather than by all partitions together.
+
+    Cross-partition aggregates (the medians used for imputation) are
+    computed afterwards in a second pass over the written files and saved
+    next to them (see read_final_data).
+
+    Inputs:
+        acs5_loader (function) takes a state FIPS code (str) and returns
+            the processed ACS DataFrame for that state
+        partitions (list of tuples) (state, tracts_filepath, places_filepath)
+        jobs_filepath (str)
+        output_dir (str) directory to write partition pickle files to
+        job_radii (list) optional radii in meters of job accessibility
+            features to add, computed over the whole state so that jobs
+            across county lines are counted
+    Outputs:
+        (tuple) list of partition filenames written and a dictionary of
+        medians to use for imputation
+    '''
+    os.makedirs(output_dir, exist_ok=True)
+    filenames = []
+
+    for state, state_tracts_filepath, state_places_filepath in partitions:
+        acs5 = acs5_loader(state)
+        acs5['tract_GEO_ID'] = acs5['GEO_ID'].apply(lambda x: x[9:])
+        state_tracts = tract_data(state_tracts_filepath, jobs_filepath,
+                                  geo_prefix=state)
+        if job_radii:
+            state_tracts = spatial.add_job_accessibility(state_tracts, job_radii)
+        state_places = place_data(state_places_filepath)
+
+        # transit scores are queried once per state, so the requests are
+        # split across the API keys over the whole state
+        transit_score_added = add_transitscore(state_tracts, state_places)
+        del state_tracts, state_places
+
+        tract_counties = transit_score_added['tract_GEO_ID'].str[:5]
+        for county, county_data in transit_score_added.groupby(tract_counties):
+            county_acs5 = acs5[acs5['tract_GEO_ID'].str[:5] == county]
+            final_df = merge_and_clean(county_acs5, county_data)
+
+            filename = os.path.join(output_dir,
+                                    PARTITION_FILENAME_TEMPLATE.format(county))
+            final_df.to_pickle(filename)
+            filenames.append(filename)
+
+        del acs5, transit_score_added
+
+    replacement = partition_medians(filenames, pipeline.IMPUTED_COLUMNS)
+    pd.to_pickle(replacement, os.path.join(output_dir, PARTITION_MEDIANS_FILENAME))
+
+    return filenames, replacement
+
+
+def partition_medians(filenames, columns):
+    '''
+    Second pass over partition files: computes the medians of the given
+    columns across all partitions, keeping only those columns in memory.
+
+    Inputs:
+        filenames (list of str) partition pickle files
+        columns (list) column names
+    Outputs:
+        (dict) column names mapped to medians
+    '''
+    values = [pd.read_pickle(filename)[columns] for filename in filenames]
+    values = pd.concat(values, ignore_index=True)
+
+    return {column: values[column].median() for column in columns}
+
+
+def read_partitions(output_dir=PARTITION_DIR, counties=None):
+    '''
+    Reads partition files written by go_partitioned into one DataFrame.
+    If counties are given, only the files of those counties are read.
+
+    Inputs:
+        output_dir (str)
+        counties (list of str) optional 5-digit state + county FIPS codes
+    Outputs:
+        (pandas DataFrame)
+    '''
+    if counties is None:
+        pattern = os.path.join(output_dir, PARTITION_FILENAME_TEMPLATE.format('*'))
+        filenames = sorted(glob.glob(pattern))
+    else:
+        filenames = [os.path.join(output_dir, PARTITION_FILENAME_TEMPLATE.format(county))
+                     for county in sorted(set(counties))]
+        filenames = [filename for filename in filenames if os.path.exists(filename)]
+
+    if not filenames:
+        return pd.DataFrame()
+
+    return pd.concat([pd.read_pickle(filename) for filename in filenames],
+                     ignore_index=True)
+
+
+def tracts_in_places(places, tracts_filepath=tracts_filepath,
+                     places_filepath=places_filepath):
+    '''
+    Finds the tracts that intersect the given places, using the cached
+    geometry sidecars. Only the selected places are joined to the tracts.
+
+    Inputs:
+        places (list of str) place names (e.g. 'Chicago') or place GEOIDs
+        tracts_filepath, places_filepath (str)
+    Outputs:
+        (list of str) 11-digit tract ids
+    '''
+    all_places = place_data(places_filepath)
+    selected = all_places[all_places['place_name'].isin(places) |
+                          all_places['place_GEO_ID'].isin(places)]
+    tracts = geometry.load_sidecar(tracts_filepath, ['GEOID', 'NAMELSAD', 'ALAND'],
+                                   simplify_tolerance=geometry.JOIN_TOLERANCE)
+    tracts_places = gpd.sjoin(tracts[['GEOID', 'geometry']], selected,
+                              how='inner', op='intersects')
+
+    return sorted(tracts_places['GEOID'].unique())
+
+
+def filter_tracts(df, counties=None, places=None, tract_ids=None, state='17',
+                  place_tract_ids=None):
+    '''
+    Keeps the rows of the final dataframe whose tracts match all of the
+    given filters. Raises a ValueError naming the filter if a filter, or
+    all filters together, match no tracts.
+
+    Inputs:
+        df (pandas DataFrame) with a GEO_ID column
+        counties (list of str) 5-digit state + county or 3-digit county
+            FIPS codes (the latter within state)
+        places (list of str) place names or place GEOIDs
+        tract_ids (list of str) 11-digit tract ids
+        state (str) state FIPS code for 3-digit county codes
+        place_tract_ids (list of str) tracts in places, if already looked
+            up with tracts_in_places
+    Outputs:
+        (pandas DataFrame)
+    '''
+    tract_id = df['GEO_ID'].str[9:]
+    masks = []
+
+    if counties:
+        masks.append(('counties {}'.format(list(counties)),
+                      tract_id.str[:5].isin(county_codes(counties, state))))
+    if places:
+        if place_tract_ids is None:
+            place_tract_ids = tracts_in_places(places)
+        masks.append(('places {}'.format(list(places)),
+                      tract_id.isin(place_tract_ids)))
+    if tract_ids:
+        masks.append(('tract ids {}'.format(list(tract_ids)),
+                      tract_id.isin(tract_ids)))
+
+    keep = pd.Series(True, index=df.index)
+    for description, mask in masks:
+        if not mask.any():
+            raise ValueError('No tracts match {}'.format(description))
+        keep &= mask
+
+    if not keep.any():
+        raise ValueError('No tracts match all of {}'.format(
+            ', '.join(description for description, _ in masks)))
+
+    return df[keep].reset_index(drop=True)
+
+
+def county_codes(counties, state='17'):
+    '''
+    Turns 3-digit county FIPS codes into 5-digit state + county codes.
+
+    Inputs:
+        counties (list of str) 3-digit or 5-digit codes
+        state (str) state FIPS code
+    Outputs:
+        (set of str)
+    '''
+    return set(county if len(county) == 5 else state + county
+               for county in counties)
+
+
+def read_final_data(pickle_filename='pickle_files/final_data.pkl',
+                    output_dir=PARTITION_DIR, counties=None, places=None,
+                    tract_ids=None, state='17', use_partitions=False):
+    '''
+    Reads the final dataframe for model selection, keeping only the tracts
+    matching the given filters (see filter_tracts).
+
+    If use_partitions is True, the partition files written by
+    go_partitioned (e.g. by download.compile_and_merge_data_by_partition)
+    are read instead of the pickle file, and filters are pushed down to
+    the read: only the partitions of counties that can contain matching
+    tracts are read. Otherwise the full pickle file is read and filtered,
+    which saves scoring time but not memory. Partitioned data is imputed
+    with the medians over all partitions before it is filtered, so the
+    imputed values do not depend on which partitions were read.
+
+    Inputs:
+        pickle_filename (str) full final dataframe
+        output_dir (str) directory of partition files
+        counties, places, tract_ids, state: see filter_tracts
+        use_partitions (boolean) whether to read partition files instead
+            of pickle_filename
+    Outputs:
+        (pandas DataFrame)
+    '''
+    place_tract_ids = None
+    if places:
+        place_tract_ids = tracts_in_places(places)
+        if not place_tract_ids:
+            raise ValueError('No tracts match places {}'.format(list(places)))
+
+    partition_counties = county_codes(counties, state) if counties else None
+    for ids in [place_tract_ids, tract_ids]:
+        if ids:
+            ids_counties = set(tract_id[:5] for tract_id in ids)
+            partition_counties = ids_counties if partition_counties is None \
+                                 else partition_counties & ids_counties
+
+    if use_partitions:
+        df = read_partitions(output_dir, partition_counties)
+        if df.empty:
+            raise ValueError('No partitions in {} for counties {}'.format(
+                output_dir, sorted(partition_counties)))
+        medians = pd.read_pickle(os.path.join(output_dir,
+                                              PARTITION_MEDIANS_FILENAME))
+        df, _ = pipeline.impute(df, list(medians), replacement=medians)
+    else:
+        df = pd.read_pickle(pickle_filename)
+
+    return filter_tracts(df, counties=counties, places=places,
+                         tract_ids=tract_ids, state=state,
+                         place_tract_ids=place_tract_ids)
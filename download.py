@@ -4,6 +4,7 @@ import geopandas as gpd
 import pipeline
 import json
 import data_wrangling
+import stages
 
 YEAR = 2018
 STATE = '17'
@@ -12,7 +13,7 @@ STATE = '17'
 with open('CENSUS_DATA_COLS.json') as f:
     DATA_COLS = json.load(f)
 
-def compile_and_merge_data():
+def compile_and_merge_data(concurrent=True, source_dir=None, **options):
     '''
     Wrapper function to
         (1) Compile DataFrame with Census data,
@@ -21,18 +22,88 @@ def compile_and_merge_data():
             density), and
         (4) Clean/process data to create final dataframe
 
+    If concurrent is True, the steps that do not depend on each other run
+    at the same time: the ACS download in a thread, the tract and place
+    shapefile loads in processes, and the transit score queries as soon
+    as both shapefiles are loaded (see data_wrangling.go_stages).
+
+    Inputs:
+        concurrent (boolean): whether to run independent steps concurrently
+        source_dir (string): optional directory of ACS 5-year table
+            extracts to read instead of the Census API
+        options: optional arguments of data_wrangling.go (lag_columns,
+            lag_method, gtfs_feed_dirs, job_radii, pickle_filename)
+
     Output:
         A pandas DataFrame that can be used to build a model
     '''
-    acs5 = compile_acs_data(YEAR, STATE, DATA_COLS)
-    processed_acs5 = create_census_features_and_target(acs5)
+    filepaths = (data_wrangling.tracts_filepath, data_wrangling.places_filepath,
+                 data_wrangling.jobs_filepath)
+
+    if not concurrent:
+        processed_acs5 = compile_and_process_acs_data(YEAR, STATE, DATA_COLS,
+                                                      source_dir)
+        return data_wrangling.go(processed_acs5, *filepaths, **options)
+
+    acs5_stage = (compile_and_process_acs_data,
+                  (YEAR, STATE, DATA_COLS, source_dir), [], 'thread')
+    build_stages = data_wrangling.go_stages(acs5_stage, *filepaths, **options)
+    results, _ = stages.run_stages(build_stages)
+
+    return results['final']
+
 
-    return data_wrangling.go(processed_acs5)
+def compile_and_process_acs_data(year, state, data_cols, source_dir=None):
+    '''
+    Downloads ACS data and engineers Census-related features and target
+        (see compile_acs_data and create_census_features_and_target)
 
+    Inputs:
+        year (integer): year of data to be downloaded
+        state (string): encoding of state for which to pull data
+        data_cols (dict): see compile_acs_data
+        source_dir (string): optional directory of ACS 5-year table
+            extracts to read instead of the Census API
 
-def compile_acs_data(year, state, data_cols):
+    Output:
+        A pandas DataFrame
     '''
-    Downloads 5-year American Community Survey data from Census API,
+    acs5 = compile_acs_data(year, state, data_cols, source_dir)
+
+    return create_census_features_and_target(acs5)
+
+
+def compile_and_merge_data_by_partition(states=(STATE,), source_dir=None):
+    '''
+    Streaming version of compile_and_merge_data. Downloads and processes
+    one state at a time and writes the cleaned data to one pickle file
+    per county (see data_wrangling.go_partitioned).
+
+    Inputs:
+        states (list of strings): encodings of states for which to pull data
+        source_dir (string): optional directory of ACS 5-year table
+            extracts to read instead of the Census API
+
+    Output:
+        (tuple) list of partition filenames and a dictionary of medians to
+        use for imputation
+    '''
+    partitions = [(state,
+                   data_wrangling.TRACTS_FILEPATH_TEMPLATE.format(state),
+                   data_wrangling.PLACES_FILEPATH_TEMPLATE.format(state))
+                  for state in states]
+
+    def acs5_loader(state):
+        return compile_and_process_acs_data(YEAR, state, DATA_COLS, source_dir)
+
+    return data_wrangling.go_partitioned(acs5_loader, partitions,
+                                         data_wrangling.jobs_filepath)
+
+
+def compile_acs_data(year, state, data_cols, source_dir=None):
+    '''
+    Downloads 5-year American Community Survey data from Census API, or
+        reads it from local table extracts if source_dir is given,
         creates features for model, and removes original downloaded attributes
 
     Inputs:
@@ -41,11 +112,16 @@ def compile_acs_data(year, state, data_cols):
         data_cols (dict): keys are the columns (strings) to pull from the
             Census API, values are labels (strings) that should be given to
             the columns in the analysis
+        source_dir (string): optional directory of ACS 5-year table
+            extracts to read instead of calling the Census API
 
     Output:
         A pandas DataFrame with the necessary data for the analysis
 
     '''
+    if source_dir:
+        return pipeline.get_acs_5_data_bulk(year, state, data_cols, source_dir)
+
     return pipeline.get_acs_5_data(year, state, data_cols)
 
 
@@ -156,8 +232,7 @@ def create_census_features_and_target(acs5):
                             acs5["industry_emp_total"]
     acs5['median_income'] = acs5['income_median']
     acs5['renter_rate'] = acs5['home_rent_yes'] / acs5['home_own_status']
-    # the following line drops original count values so that the ACS data
-    # only contains the transformations above
-    
+    # original count values are dropped later on in
+    # data_wrangling.data_cleaning, once the other features are computed
 
-    return acs5_processed
+    return acs5
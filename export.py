@@ -0,0 +1,121 @@
+'''
+Export recommended tracts with simplified geometry for web maps
+'''
+import os
+import numpy as np
+import geopandas as gpd
+from shapely.ops import transform
+import geometry
+import data_wrangling
+
+EXPORT_DIR = 'exports'
+# web map zoom levels to export; polygons are simplified to about one
+# pixel at each level
+ZOOM_LEVELS = [8, 10, 12]
+# meters per pixel of 256px web mercator tiles at zoom 0
+METERS_PER_PIXEL_AT_ZOOM_0 = 156543.03
+# decimal places kept in exported coordinates (about 1 meter)
+COORDINATE_PRECISION = 5
+
+
+def zoom_tolerance(zoom):
+    '''
+    Simplification tolerance in meters for a web map zoom level.
+
+    Inputs:
+        zoom (int)
+    Outputs:
+        (float)
+    '''
+    return METERS_PER_PIXEL_AT_ZOOM_0 / 2 ** zoom
+
+
+def quantize(geom, precision=COORDINATE_PRECISION):
+    '''
+    Rounds the coordinates of a geometry to a number of decimal places.
+
+    Inputs:
+        geom (shapely geometry)
+        precision (int)
+    Outputs:
+        (shapely geometry)
+    '''
+    return transform(lambda x, y, z=None: (np.round(x, precision),
+                                           np.round(y, precision)), geom)
+
+
+def geoparquet_supported():
+    '''
+    Whether the installed geopandas writes GeoParquet itself (0.8 and
+    later). Older versions only inherit pandas' to_parquet, which cannot
+    serialise geometry.
+
+    Outputs:
+        (boolean)
+    '''
+    return 'to_parquet' in gpd.GeoDataFrame.__dict__
+
+
+def recommendation_geometry(results_df, zoom,
+                            tracts_filepath=data_wrangling.tracts_filepath):
+    '''
+    Joins recommended tracts to their geometry simplified for a zoom level.
+    Simplified geometry is cached per zoom level in the geometry sidecar,
+    so the tract shapefile is only parsed the first time.
+
+    Inputs:
+        results_df (pandas DataFrame) output of recommend_tracts_for_action
+            or recommend_tracts_for_review, with a tract_id column
+        zoom (int) web map zoom level
+        tracts_filepath (str)
+    Outputs:
+        (geopandas GeoDataFrame) in longitude/latitude
+    '''
+    tracts = geometry.load_sidecar(tracts_filepath, ['GEOID'],
+                                   simplify_tolerance=zoom_tolerance(zoom))
+    tracts = tracts[['GEOID', 'geometry']]
+
+    results_gdf = tracts.merge(results_df, left_on='GEOID', right_on='tract_id',
+                               how='inner').drop(columns='GEOID')
+    results_gdf = results_gdf.to_crs(geometry.GEOGRAPHIC_CRS)
+    results_gdf['geometry'] = results_gdf.geometry.apply(quantize)
+
+    return results_gdf
+
+
+def export_recommendations(results_df, name, zoom_levels=ZOOM_LEVELS,
+                           tracts_filepath=data_wrangling.tracts_filepath,
+                           export_dir=EXPORT_DIR):
+    '''
+    Writes recommended tracts with geometry, one file per zoom level, as
+    GeoJSON with quantized coordinates (ready for web maps or vector tile
+    tools) and as GeoParquet if the installed geopandas supports it and
+    pyarrow is installed.
+
+    Inputs:
+        results_df (pandas DataFrame) with a tract_id column
+        name (str) base name of the files, e.g. 'tracts_to_recommend'
+        zoom_levels (list of int)
+        tracts_filepath (str)
+        export_dir (str)
+    Outputs:
+        (list of str) filenames written
+    '''
+    os.makedirs(export_dir, exist_ok=True)
+    filenames = []
+
+    for zoom in zoom_levels:
+        results_gdf = recommendation_geometry(results_df, zoom, tracts_filepath)
+        stem = os.path.join(export_dir, '{}_z{}'.format(name, zoom))
+
+        results_gdf.to_file(stem + '.geojson', driver='GeoJSON')
+        filenames.append(stem + '.geojson')
+
+        if geoparquet_supported():
+            try:
+                results_gdf.to_parquet(stem + '.parquet')
+                filenames.append(stem + '.parquet')
+            except ImportError:
+                print('Skipping GeoParquet output: pyarrow is not installed')
+
+    return filenames
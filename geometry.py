@@ -0,0 +1,114 @@
+'''
+Preprocess TIGER shapefiles into compact, cached sidecar tables so that
+feature building does not have to parse full polygons on every run
+'''
+import os
+import hashlib
+import pandas as pd
+import geopandas as gpd
+
+# projected CRS (CONUS Albers, meters) for centroids, areas and distances
+PROJECTED_CRS = 'EPSG:5070'
+GEOGRAPHIC_CRS = 'EPSG:4326'
+SIDECAR_DIR = 'pickle_files/geometry'
+# simplification tolerance (meters) of the geometry used for spatial joins
+JOIN_TOLERANCE = 10
+CHECKSUM_BLOCKSIZE = 2 ** 20
+
+
+def file_checksum(shp_filepath):
+    '''
+    Computes an md5 checksum of the geometry (.shp) and attribute (.dbf)
+    files of a shapefile. Hashing the raw bytes is much cheaper than
+    parsing the shapefile.
+
+    Inputs:
+        shp_filepath (str)
+    Outputs:
+        (str) hex digest
+    '''
+    md5 = hashlib.md5()
+    stem = os.path.splitext(shp_filepath)[0]
+
+    for ending in ['.shp', '.dbf']:
+        with open(stem + ending, 'rb') as f:
+            for block in iter(lambda: f.read(CHECKSUM_BLOCKSIZE), b''):
+                md5.update(block)
+
+    return md5.hexdigest()
+
+
+def build_sidecar(shp_filepath, columns, simplify_tolerance=None):
+    '''
+    Parses a shapefile once and builds its sidecar table: the requested
+    attribute columns, projected and geographic centroids, projected area
+    and bounding box, and optionally a simplified geometry.
+
+    Centroids are computed in PROJECTED_CRS rather than in degrees; the
+    geographic centroid is the projected centroid converted back to
+    longitude/latitude.
+
+    Inputs:
+        shp_filepath (str)
+        columns (list) attribute columns to keep, e.g. ['GEOID', 'ALAND']
+        simplify_tolerance (float) optional tolerance in meters; if given,
+            a simplified geometry column (in PROJECTED_CRS) is kept
+    Outputs:
+        (pandas DataFrame)
+    '''
+    shapes = gpd.read_file(shp_filepath)
+    projected = shapes.geometry.to_crs(PROJECTED_CRS)
+    centroids = projected.centroid
+    geographic_centroids = gpd.GeoSeries(centroids, crs=PROJECTED_CRS) \
+                              .to_crs(GEOGRAPHIC_CRS)
+
+    sidecar = pd.DataFrame(shapes[columns])
+    sidecar['centroid_x'] = centroids.x
+    sidecar['centroid_y'] = centroids.y
+    sidecar['centroid_lng'] = geographic_centroids.x
+    sidecar['centroid_lat'] = geographic_centroids.y
+    sidecar['area'] = projected.area
+    bounds = projected.bounds
+    for col in ['minx', 'miny', 'maxx', 'maxy']:
+        sidecar[col] = bounds[col]
+
+    if simplify_tolerance is not None:
+        sidecar['geometry'] = projected.simplify(simplify_tolerance,
+                                                 preserve_topology=True)
+
+    return sidecar
+
+
+def load_sidecar(shp_filepath, columns, simplify_tolerance=None,
+                 sidecar_dir=SIDECAR_DIR):
+    '''
+    Loads the sidecar table of a shapefile, building and caching it first
+    if no sidecar exists for the current checksum of the file.
+
+    Inputs:
+        shp_filepath (str)
+        columns (list) attribute columns to keep
+        simplify_tolerance (float) optional tolerance in meters of the
+            simplified geometry to keep
+        sidecar_dir (str) directory of cached sidecar files
+    Outputs:
+        (pandas DataFrame, or geopandas GeoDataFrame in PROJECTED_CRS if
+        simplify_tolerance is given)
+    '''
+    stem = os.path.splitext(os.path.basename(shp_filepath))[0]
+    filename = os.path.join(sidecar_dir, '{}_{}_{}_{}.pkl'.format(
+        stem, file_checksum(shp_filepath)[:12], '_'.join(columns),
+        simplify_tolerance))
+
+    if os.path.exists(filename):
+        sidecar = pd.read_pickle(filename)
+    else:
+        sidecar = build_sidecar(shp_filepath, columns, simplify_tolerance)
+        os.makedirs(sidecar_dir, exist_ok=True)
+        sidecar.to_pickle(filename)
+
+    if simplify_tolerance is not None:
+        sidecar = gpd.GeoDataFrame(sidecar, geometry='geometry',
+                                   crs=PROJECTED_CRS)
+
+    return sidecar
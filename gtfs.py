@@ -0,0 +1,181 @@
+'''
+Offline transit accessibility scores for census tracts from GTFS feeds,
+as an alternative to querying the WalkScore API
+'''
+import os
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+from scipy.spatial import cKDTree
+import geometry
+
+# relative value of a departure by GTFS route_type: rail modes count
+# double a bus departure, ferries one and a half
+ROUTE_TYPE_WEIGHTS = {0: 2.0, 1: 2.0, 2: 2.0, 3: 1.0, 4: 1.5}
+DEFAULT_ROUTE_TYPE_WEIGHT = 1.0
+# stops further than RADIUS meters from a tract centroid are ignored, and
+# closer stops count less the further away they are
+RADIUS = 800
+DECAY_DISTANCE = 400
+MAX_SCORE = 100
+STOP_TIMES_CHUNKSIZE = 1000000
+
+
+def load_feed(feed_dir):
+    '''
+    Reads a GTFS feed from disk and counts departures per stop and route.
+    stop_times.txt is read in chunks, keeping only trip and stop ids.
+
+    Inputs:
+        feed_dir (str) directory with stops.txt, stop_times.txt, trips.txt
+            and routes.txt
+    Outputs:
+        (pandas DataFrame) one row per stop and route with the stop's
+        location, the route type and the number of departures
+    '''
+    def read(name, cols):
+        return pd.read_csv(os.path.join(feed_dir, name), usecols=cols, dtype=str)
+
+    stops = read('stops.txt', ['stop_id', 'stop_lat', 'stop_lon'])
+    stops[['stop_lat', 'stop_lon']] = stops[['stop_lat', 'stop_lon']].astype(float)
+    trips = read('trips.txt', ['trip_id', 'route_id'])
+    routes = read('routes.txt', ['route_id', 'route_type'])
+    routes['route_type'] = routes['route_type'].astype(int)
+
+    counts = []
+    for chunk in pd.read_csv(os.path.join(feed_dir, 'stop_times.txt'),
+                             usecols=['trip_id', 'stop_id'], dtype=str,
+                             chunksize=STOP_TIMES_CHUNKSIZE):
+        chunk = chunk.merge(trips, on='trip_id')
+        counts.append(chunk.groupby(['stop_id', 'route_id']).size())
+
+    departures = pd.concat(counts).groupby(level=[0, 1]).sum() \
+                   .rename('departures').reset_index()
+    service = departures.merge(routes, on='route_id') \
+                        .merge(stops, on='stop_id')
+
+    return service
+
+
+def load_feeds(feed_dirs):
+    '''
+    Reads several GTFS feeds (e.g. one per agency) into one table. Stop and
+    route ids are prefixed with the feed's directory name to keep them
+    unique across feeds.
+
+    Inputs:
+        feed_dirs (list of str)
+    Outputs:
+        (pandas DataFrame) see load_feed
+    '''
+    feeds = []
+    for feed_dir in feed_dirs:
+        service = load_feed(feed_dir)
+        prefix = os.path.basename(os.path.normpath(feed_dir)) + ':'
+        service['stop_id'] = prefix + service['stop_id']
+        service['route_id'] = prefix + service['route_id']
+        feeds.append(service)
+
+    return pd.concat(feeds, ignore_index=True)
+
+
+def scale_service(service, factor, route_ids=None):
+    '''
+    Simulates a service change by scaling the number of departures.
+
+    Inputs:
+        service (pandas DataFrame) output of load_feeds
+        factor (float) e.g. 1.5 for 50% more frequent service
+        route_ids (list) optional routes to change; all routes if None
+    Outputs:
+        (pandas DataFrame) copy of service with departures scaled
+    '''
+    new_service = service.copy()
+    changed = np.ones(len(service), dtype=bool) if route_ids is None \
+              else service['route_id'].isin(route_ids).values
+    new_service.loc[changed, 'departures'] = \
+        new_service.loc[changed, 'departures'] * factor
+
+    return new_service
+
+
+def score_tracts(tracts, service, scale=None, radius=RADIUS,
+                 decay_distance=DECAY_DISTANCE, cap=True):
+    '''
+    Computes a 0-100 transit accessibility score for every tract: the sum,
+    over stops within radius of the tract centroid, of mode-weighted
+    departures decayed exponentially with distance, put on a log scale.
+
+    Stops are indexed in a KD-tree and all centroids are queried at once.
+    To compare scenarios (see scale_service), pass the scale returned for
+    the baseline so that scores stay on the same scale.
+
+    Inputs:
+        tracts (pandas DataFrame) with tract_GEO_ID and projected centroid_x
+            and centroid_y columns (e.g. output of data_wrangling.tract_data)
+        service (pandas DataFrame) output of load_feeds
+        scale (float) raw accessibility that maps to MAX_SCORE; defaults
+            to the highest raw accessibility among the tracts
+        radius, decay_distance (float) in meters
+        cap (boolean) whether to cap scores above the scale at MAX_SCORE
+    Outputs:
+        (tuple) pandas Series of scores indexed by tract_GEO_ID, and the
+        scale used
+    '''
+    service = service.assign(weighted_departures=service['departures'] *
+        service['route_type'].map(ROUTE_TYPE_WEIGHTS)
+                             .fillna(DEFAULT_ROUTE_TYPE_WEIGHT))
+    stops = service.groupby(['stop_id', 'stop_lon', 'stop_lat'], as_index=False) \
+                   ['weighted_departures'].sum()
+
+    points = gpd.GeoSeries(gpd.points_from_xy(stops['stop_lon'], stops['stop_lat']),
+                           crs=geometry.GEOGRAPHIC_CRS).to_crs(geometry.PROJECTED_CRS)
+    stop_tree = cKDTree(np.column_stack([points.x, points.y]))
+    tract_tree = cKDTree(tracts[['centroid_x', 'centroid_y']].values)
+
+    pairs = tract_tree.sparse_distance_matrix(stop_tree, radius,
+                                              output_type='ndarray')
+    contributions = np.exp(-pairs['v'] / decay_distance) * \
+                    stops['weighted_departures'].values[pairs['j']]
+    accessibility = np.bincount(pairs['i'], weights=contributions,
+                                minlength=len(tracts))
+
+    if scale is None:
+        scale = accessibility.max()
+    if scale > 0:
+        scores = MAX_SCORE * np.log1p(accessibility) / np.log1p(scale)
+        if cap:
+            scores = np.minimum(scores, MAX_SCORE)
+    else:
+        # no service near any tract
+        scores = np.zeros(len(tracts))
+
+    return pd.Series(scores, index=tracts['tract_GEO_ID'].values,
+                     name='transit_score'), scale
+
+
+def score_changes(tracts, baseline_service, scenario_service,
+                  radius=RADIUS, decay_distance=DECAY_DISTANCE):
+    '''
+    Change in transit score of every tract under a service scenario (see
+    scale_service), relative to the baseline service, with both scored on
+    the baseline's scale. Scores are not capped, so tracts whose scenario
+    access exceeds the best-served baseline tract still show their full
+    change. The changes can be added to transit scores from any source,
+    including WalkScore.
+
+    Inputs:
+        tracts (pandas DataFrame) see score_tracts
+        baseline_service, scenario_service (pandas DataFrame) output of
+            load_feeds and scale_service
+        radius, decay_distance (float) in meters
+    Outputs:
+        (pandas Series) scenario minus baseline score, indexed by
+        tract_GEO_ID
+    '''
+    baseline, scale = score_tracts(tracts, baseline_service, None, radius,
+                                   decay_distance, cap=False)
+    scenario, _ = score_tracts(tracts, scenario_service, scale, radius,
+                               decay_distance, cap=False)
+
+    return scenario - baseline
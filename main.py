@@ -4,14 +4,17 @@ File to pull data, find best model, and recommend tracts for intervention
 
 import argparse
 import pandas as pd
+from sklearn.pipeline import Pipeline
 import model_selection as select
 import download as dl
 import model_selection
 import recommend as rcmd
+import data_wrangling
+import export
 
-DATA_DF = pd.read_pickle("./pickle_files/final_data.pkl")
 BEST_MODEL = pd.read_pickle('./pickle_files/best_model.pkl').steps[-1][1]
-POLY_DEGREE = pd.read_pickle('./pickle_files/best_model.pkl').steps[-2][1].powers_[-1][-1]
+# fitted scaling and feature expansion steps that precede the estimator
+PREPROCESSING = Pipeline(pd.read_pickle('./pickle_files/best_model.pkl').steps[:-1])
 K = 5
 
 def go():
@@ -30,30 +33,89 @@ def go():
                         action='store_true',
                         help='Use archived version of model and data')
 
+    parser.add_argument('-i',
+                        default=False,
+                        action='store_true',
+                        help='''Pull data, then warm-start the archived model
+                        instead of rerunning the full grid search''')
+
+    parser.add_argument('--county',
+                        nargs='+',
+                        help='''Only score and recommend tracts in these
+                        counties (3-digit county or 5-digit state + county
+                        FIPS codes)''')
+
+    parser.add_argument('--place',
+                        nargs='+',
+                        help='''Only score and recommend tracts intersecting
+                        these places (names or GEOIDs)''')
+
+    parser.add_argument('--tract',
+                        nargs='+',
+                        help='Only score and recommend these tracts (11-digit ids)')
+
+    parser.add_argument('--partitions',
+                        default=False,
+                        action='store_true',
+                        help='''With -d or -m, read the archived data from the
+                        per-county partition files instead of one file''')
+
+    parser.add_argument('-n',
+                        type=int,
+                        default=30,
+                        help='Number of tracts to recommend')
+
+    parser.add_argument('--top-features',
+                        type=int,
+                        default=3,
+                        help='''Number of top contributing features to add to
+                        each recommended tract (0 for none)''')
+
+    parser.add_argument('--export',
+                        default=False,
+                        action='store_true',
+                        help='''Write recommended tracts with map-ready geometry
+                        to the exports folder''')
+
     args = parser.parse_args()
+    filters = {'counties': args.county, 'places': args.place,
+               'tract_ids': args.tract}
 
     if args.m:
         print('''Using archived model and data instead of pulling data via
         API and finding best model using grid search''')
-        data_df = DATA_DF
+        data_df = data_wrangling.read_final_data(use_partitions=args.partitions,
+                                                 **filters)
         best_model = BEST_MODEL
-        poly_degree = POLY_DEGREE
+        preprocessing = PREPROCESSING
 
     elif args.d:
         print('Using archived files instead of pulling all data via API')
-        data_df = DATA_DF
-        pf, best_model = select.model_selection(K, data_df)
+        data_df = data_wrangling.read_final_data(use_partitions=args.partitions)
+        preprocessing, best_model = select.model_selection(K, data_df)
 
-        poly_degree = pf.powers_[-1][-1]
+    elif args.i:
+        print('Retraining archived model incrementally on new data')
+        data_df = dl.compile_and_merge_data()
+        preprocessing, best_model = select.incremental_model_selection(K, data_df)
 
     else:
         data_df = dl.compile_and_merge_data()
-        pf, best_model = select.model_selection(K, data_df)
+        preprocessing, best_model = select.model_selection(K, data_df)
+
+    # archived data is filtered as it is read
+    if any(filters.values()) and not args.m:
+        data_df = data_wrangling.filter_tracts(data_df, **filters)
+
+    results_df = rcmd.recommend_tracts_for_action(data_df, best_model,
+                                                  n_tracts=args.n,
+                                                  preprocessing=preprocessing,
+                                                  n_top_features=args.top_features)
 
-        poly_degree = pf.powers_[-1][-1]
+    if args.export:
+        export.export_recommendations(results_df, 'tracts_to_recommend')
 
-    return rcmd.recommend_tracts_for_action(data_df, best_model,
-                                                  num_poly=poly_degree)
+    return results_df
 
 
 if __name__ == '__main__':
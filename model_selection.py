@@ -1,8 +1,9 @@
 from sklearn.model_selection import train_test_split
 from sklearn.pipeline import Pipeline
-from sklearn.preprocessing import StandardScaler, PolynomialFeatures
+from sklearn.preprocessing import StandardScaler
 from sklearn.linear_model import LinearRegression, Lasso, Ridge, ElasticNet
-from sklearn.ensemble import RandomForestRegressor
+from sklearn.experimental import enable_hist_gradient_boosting  # noqa
+from sklearn.ensemble import RandomForestRegressor, HistGradientBoostingRegressor
 from sklearn.tree import DecisionTreeRegressor
 from sklearn.metrics import mean_squared_error, r2_score
 import numpy as np
@@ -12,7 +13,9 @@ from math import sqrt
 from ast import literal_eval
 import datetime
 import json
+import os
 from pipeline import grid_search_cv, find_best_model, run_best_model, format_keynames
+from pipeline import InteractionFeatures
 import warnings
 warnings.filterwarnings("ignore")
 
@@ -24,7 +27,13 @@ ridge = Ridge(max_iter=5000)
 en = ElasticNet(max_iter=5000)
 dt = DecisionTreeRegressor()
 rf = RandomForestRegressor(random_state=0, n_jobs=-1, verbose=2)
-pf = PolynomialFeatures()
+hgb = HistGradientBoostingRegressor(max_iter=1000, early_stopping=True,
+                                    validation_fraction=0.1,
+                                    n_iter_no_change=10, random_state=0)
+pf = InteractionFeatures()
+
+# features that interact with every other feature at pf__degree 2
+FOCUS_FEATURES = ['transit_score']
 
 PIPELINES = {"regr": Pipeline([("scale", scale),
                                ("pf", pf),
@@ -41,7 +50,9 @@ PIPELINES = {"regr": Pipeline([("scale", scale),
             "decisiontree": Pipeline([("pf", pf),
                                       ("decisiontree", dt)]),
             "randomforest": Pipeline([("pf", pf),
-                                      ("randomforest", rf)])}
+                                      ("randomforest", rf)]),
+            "histgb": Pipeline([("pf", pf),
+                                ("histgb", hgb)])}
 
 
 PARAMS = {
@@ -59,7 +70,19 @@ PARAMS = {
 'randomforest': {'pf__degree': [1, 2],
                  'randomforest__criterion': ['mse', 'mae'],
                  'randomforest__n_estimators': [100, 200, 300],
-                 'randomforest__max_depth': [5, 10, 15]}}
+                 'randomforest__max_depth': [5, 10, 15]},
+# gradient boosting finds interactions itself, so it only sees raw features
+'histgb': {'pf__degree': [1],
+           'histgb__learning_rate': [0.05, 0.1],
+           'histgb__max_leaf_nodes': [15, 31, 63],
+           'histgb__l2_regularization': [0, 1.0]}}
+
+
+# maximum relative increase in validation RMSE before incremental
+# retraining falls back to a full grid search
+DRIFT_TOLERANCE = 0.1
+# trees added to a random forest when warm-starting it
+N_ESTIMATORS_TO_ADD = 100
 
 
 PARAMS_SMALL = {
@@ -76,23 +99,25 @@ PIPELINES_SMALL = {'regr': Pipeline([('scale', scale),
                                ('lasso', lasso)])}
 
 
-def model_selection(k, df, small=False, verbose=False):
+def data_features(df):
     '''
-    Selects best model given preselected models and hyperparameters.
-    Runs smaller model for testing if small is True.
-    Inputs: k (int) specification of number of folds for k-fold cross-
-    validation
-    df (DataFrame) pre-cleaned data
-    small (boolean) a flag indicating whether the user wants to use a smaller
-    pipeline for testing or the larger pipeline
-    verbose (boolean) a flag indicating whether the user wants to see formatted
-    output of the model in addition to return values
-    Returns: (tuple) polynomial features and model steps of Pipeline object for the best
-    model
+    Features of pre-cleaned data: all columns but the target and GEO_ID.
+    Inputs: df (DataFrame) pre-cleaned data
+    Returns: (DataFrame) features
+    '''
+    return df.drop(['commuting_ridership', 'GEO_ID'], axis=1)
+
+
+def split_data(df):
+    '''
+    Splits pre-cleaned data into train and test sets and imputes the median
+    for missing values in the median_income column.
+    Inputs: df (DataFrame) pre-cleaned data
+    Returns: (tuple) x_train, x_test, y_train, y_test
     '''
     data = df
 
-    features = data.drop(['commuting_ridership', 'GEO_ID'], axis=1)
+    features = data_features(data)
     target = data['commuting_ridership'].to_frame('commuting_ridership')
 
     # splitting data into train and test sets
@@ -105,6 +130,25 @@ def model_selection(k, df, small=False, verbose=False):
     y_train = np.ravel(y_train)
     y_test = np.ravel(y_test)
 
+    return x_train, x_test, y_train, y_test
+
+
+def model_selection(k, df, small=False, verbose=False):
+    '''
+    Selects best model given preselected models and hyperparameters.
+    Runs smaller model for testing if small is True.
+    Inputs: k (int) specification of number of folds for k-fold cross-
+    validation
+    df (DataFrame) pre-cleaned data
+    small (boolean) a flag indicating whether the user wants to use a smaller
+    pipeline for testing or the larger pipeline
+    verbose (boolean) a flag indicating whether the user wants to see formatted
+    output of the model in addition to return values
+    Returns: (tuple) preprocessing steps (scaling and feature expansion) and
+    model step of Pipeline object for the best model
+    '''
+    x_train, x_test, y_train, y_test = split_data(df)
+
     if small: 
         pipelines = PIPELINES_SMALL
         params = PARAMS_SMALL
@@ -112,6 +156,10 @@ def model_selection(k, df, small=False, verbose=False):
         pipelines = PIPELINES
         params = PARAMS
 
+    focus = [x_train.columns.get_loc(col) for col in FOCUS_FEATURES]
+    for pipeline in pipelines.values():
+        pipeline.set_params(pf__focus=focus)
+
     best, results = grid_search_cv(pipelines, params, 
                                    'neg_root_mean_squared_error', k, 
                                    x_train, y_train)
@@ -146,4 +194,95 @@ def model_selection(k, df, small=False, verbose=False):
         print('-------------------------------------------')
         print(df)
 
-    return best_model.named_steps["pf"], best_model.named_steps[model]
+    return Pipeline(best_model.steps[:-1]), best_model.named_steps[model]
+
+
+def incremental_model_selection(k, df, drift_tolerance=DRIFT_TOLERANCE,
+                                verbose=False):
+    '''
+    Retrains the archived best model on expanded data (e.g. a new ACS
+    vintage or state) instead of rerunning the full grid search. The model
+    is warm-started: lasso and elastic net start from their existing
+    coefficients and random forests keep their trees and add
+    N_ESTIMATORS_TO_ADD new ones. Other families are refit: closed-form and
+    single-tree fits are cheap, and gradient boosting cannot be warm-started
+    on new data because its features are binned again, so the existing
+    trees no longer match the bins.
+    If the archived model's RMSE on rows it was not trained on is more than
+    drift_tolerance worse than its test RMSE when it was selected,
+    hyperparameters are searched again with model_selection. The same
+    check is made on the retrained model before it replaces the archived
+    one.
+    Inputs: k (int) specification of number of folds for k-fold cross-
+    validation, used if the grid search is rerun
+    df (DataFrame) pre-cleaned data, including the new data
+    drift_tolerance (float) maximum relative increase in validation RMSE
+    verbose (boolean) a flag indicating whether the user wants to see
+    formatted output of the model in addition to return values
+    Returns: (tuple) preprocessing steps (scaling and feature expansion) and
+    model step of Pipeline object for the best model
+    '''
+    x_train, x_test, y_train, y_test = split_data(df)
+
+    best_model = pd.read_pickle(pl.BEST_MODEL_FILENAME)
+    model = best_model.steps[-1][0]
+    metrics = {}
+    if os.path.exists(pl.BEST_MODEL_METRICS_FILENAME):
+        metrics = pd.read_pickle(pl.BEST_MODEL_METRICS_FILENAME)
+
+    # check drift on rows the archived model was not trained on; archives
+    # without recorded training rows can only be checked on the test set
+    features = data_features(df)
+    old_train_rows = metrics.get('train_rows')
+    if old_train_rows is not None:
+        unseen = ~np.isin(pl.row_hashes(features), old_train_rows)
+        x_check, _ = pl.impute(features[unseen].copy(), ['median_income'])
+        y_check = df['commuting_ridership'].values[unseen]
+    else:
+        x_check, y_check = x_test, y_test
+
+    reference_rmse = metrics.get('RMSE')
+    if len(x_check) and reference_rmse is not None:
+        current_rmse = sqrt(mean_squared_error(y_check,
+                                               best_model.predict(x_check)))
+        if current_rmse > reference_rmse * (1 + drift_tolerance):
+            print('Validation RMSE drifted from {0:.3f} to {1:.3f}; rerunning '
+                  'grid search'.format(reference_rmse, current_rmse))
+            return model_selection(k, df, verbose=verbose)
+
+    estimator = best_model.named_steps[model]
+    if model in ('lasso', 'elasticnet'):
+        estimator.set_params(warm_start=True)
+    elif model == 'randomforest':
+        estimator.set_params(warm_start=True,
+                             n_estimators=estimator.n_estimators + N_ESTIMATORS_TO_ADD)
+
+    start = datetime.datetime.now()
+    best_model.fit(x_train, y_train)
+    print("Time Elapsed:", datetime.datetime.now() - start)
+
+    # later fits of the saved model should start from scratch
+    if 'warm_start' in estimator.get_params():
+        estimator.set_params(warm_start=False)
+
+    rmse = sqrt(mean_squared_error(y_test, best_model.predict(x_test)))
+    if reference_rmse is not None and rmse > reference_rmse * (1 + drift_tolerance):
+        print('Retrained RMSE of {0:.3f} is worse than {1:.3f}; rerunning '
+              'grid search'.format(rmse, reference_rmse))
+        return model_selection(k, df, verbose=verbose)
+
+    train_rows = pl.row_hashes(x_train)
+    if old_train_rows is not None:
+        train_rows = np.union1d(old_train_rows, train_rows)
+    pl.save_best_model(best_model, model, rmse, train_rows)
+
+    if verbose:
+        print('------------------------------------------------')
+        print('Results of Incrementally Retraining Best Model')
+        print('------------------------------------------------')
+        print('Model: ' + model)
+        if reference_rmse is not None:
+            print('Previous RMSE: {0:.3f}'.format(reference_rmse))
+        print('RMSE: {0:.3f}'.format(rmse))
+
+    return Pipeline(best_model.steps[:-1]), best_model.named_steps[model]
@@ -6,6 +6,8 @@ import seaborn as sns
 from sklearn.model_selection import train_test_split, GridSearchCV
 from sklearn.pipeline import Pipeline
 from sklearn.preprocessing import StandardScaler
+from sklearn.base import BaseEstimator, TransformerMixin
+from scipy import sparse
 from sklearn.metrics import accuracy_score, precision_score, recall_score
 from sklearn.linear_model import LinearRegression
 from sklearn.svm import LinearSVC
@@ -14,8 +16,25 @@ from sklearn.metrics import mean_squared_error, r2_score
 from ast import literal_eval
 from math import sqrt
 import datetime
+import copy
 import censusdata
 import pickle
+import os
+import glob
+import zipfile
+import joblib
+
+IMPORTANCE_CACHE_DIR = 'pickle_files/importance'
+# data.census.gov table extracts, e.g. ACSDT5Y2018.B08301_data_with_overlays_<date>.csv
+ACS_TABLE_FILENAME_TEMPLATE = 'ACSDT5Y{}.{}*'
+ACS_TRACT_GEO_PREFIX = '1400000US'
+# value the Census API returns for estimates that are not available
+ACS_MISSING_VALUE = -666666666
+ACS_CHUNKSIZE = 50000
+BEST_MODEL_FILENAME = 'pickle_files/best_model.pkl'
+# columns whose missing values are imputed before modeling
+IMPUTED_COLUMNS = ['median_income']
+BEST_MODEL_METRICS_FILENAME = 'pickle_files/best_model_metrics.pkl'
 
 def get_acs_5_data(year, state, data_aliases):
     '''
@@ -69,6 +88,120 @@ def get_acs_5_data(year, state, data_aliases):
     return results_df
 
 
+def get_acs_5_data_bulk(year, state, data_aliases, source_dir):
+    '''
+    Offline alternative to get_acs_5_data: gets American Community Survey
+    5-year data at tract level from locally stored table extracts (CSV or
+    zip files downloaded from data.census.gov) instead of the Census API.
+
+    Each table is read once, in chunks, keeping only the GEO_ID column,
+    the requested variables of that table and tract-level rows of the
+    state. Values that are not available are set to the value the Census
+    API returns for them, so the output matches get_acs_5_data.
+
+    Inputs:
+        year (integer): year of the data
+        state (string): encoding of state for which to get data, or None
+            for all states in the files
+        data_aliases (dictionary; keys and values both strings): mapping of
+            encoded data columns with their descriptive names, as in
+            get_acs_5_data
+        source_dir (string): directory of the table extracts
+
+    Output:
+        A pandas dataframe with ACS data
+    '''
+    tables = {}
+    for variable in data_aliases:
+        if variable != 'GEO_ID':
+            tables.setdefault(variable.split('_')[0], []).append(variable)
+
+    geo_prefix = ACS_TRACT_GEO_PREFIX + (state or '')
+    results_df = None
+    for table, variables in tables.items():
+        table_df = read_acs_table(find_acs_table_file(source_dir, year, table),
+                                  variables, geo_prefix)
+        results_df = table_df if results_df is None else \
+                     results_df.merge(table_df, on='GEO_ID')
+
+    results_df = results_df.rename(columns=data_aliases)
+    results_df['year'] = year
+
+    return results_df[list(data_aliases.values()) + ['year']]
+
+
+def find_acs_table_file(source_dir, year, table):
+    '''
+    Finds the extract of an ACS 5-year table in a directory.
+    Inputs: source_dir (str), year (int), table (str) e.g. 'B08301'
+    Output: (str) filename of a .csv or .zip file
+    '''
+    pattern = os.path.join(source_dir, ACS_TABLE_FILENAME_TEMPLATE.format(year, table))
+    filenames = sorted(filename for filename in glob.glob(pattern)
+                       if filename.endswith(('.csv', '.zip')))
+    if not filenames:
+        raise FileNotFoundError('No extract of table {} for {} in {}'
+                                .format(table, year, source_dir))
+
+    return filenames[0]
+
+
+def read_acs_table(filename, variables, geo_prefix):
+    '''
+    Reads the given variables of the rows whose GEO_ID starts with
+    geo_prefix from an ACS table extract, in chunks.
+    Inputs: filename (str) .csv or .zip extract
+    variables (list) variable names, e.g. 'B08301_001E'
+    geo_prefix (str) e.g. '1400000US17' for tracts in Illinois
+    Output: a pandas dataframe with GEO_ID and the variables
+    '''
+    if filename.endswith('.zip'):
+        archive = zipfile.ZipFile(filename)
+        members = [name for name in archive.namelist() if name.endswith('.csv')]
+        data_members = [name for name in members if 'data_with_overlays' in name]
+        handle = archive.open((data_members or members)[0])
+    else:
+        archive = None
+        handle = open(filename, 'rb')
+
+    chunks = []
+    try:
+        # the second row of the extracts holds column labels
+        for chunk in pd.read_csv(handle, usecols=['GEO_ID'] + variables,
+                                 skiprows=[1], dtype=str,
+                                 chunksize=ACS_CHUNKSIZE):
+            chunks.append(chunk[chunk['GEO_ID'].str.startswith(geo_prefix)])
+    finally:
+        handle.close()
+        if archive is not None:
+            archive.close()
+
+    table_df = pd.concat(chunks, ignore_index=True)
+    table_df[variables] = table_df[variables].apply(acs_table_values) \
+                                             .fillna(ACS_MISSING_VALUE)
+
+    return table_df
+
+
+def acs_table_values(column):
+    '''
+    Converts a column of an ACS table extract to the values the Census API
+    returns. The extracts write thousands separators and top and bottom
+    codes as strings: "250,000+" is 250001 in the API and "2,500-" is
+    2499. Other non-numeric values (e.g. "-" or "N") are missing.
+    Input: column (pandas Series) of strings
+    Output: a pandas series of floats
+    '''
+    values = column.str.replace(',', '').str.strip()
+    top_coded = values.str.endswith('+', na=False)
+    bottom_coded = values.str.endswith('-', na=False) & (values.str.len() > 1)
+    numbers = pd.to_numeric(values.str.rstrip('+-'), errors='coerce')
+    numbers[top_coded] += 1
+    numbers[bottom_coded] -= 1
+
+    return numbers
+
+
 def read_data(filename):
     '''
     Reads files into dataframes or geodataframes, depending on suffix.
@@ -192,6 +325,103 @@ def impute(df, columns, replacement=None):
     return df, replacement
 
 
+class InteractionFeatures(BaseEstimator, TransformerMixin):
+    '''
+    Targeted alternative to sklearn's PolynomialFeatures. Degree 1 gives a
+    bias and the raw features, like PolynomialFeatures. Degree 2 adds only
+    the interactions of the focus features with every other feature, plus
+    the squares of all features, instead of every pairwise product.
+
+    Like PolynomialFeatures it exposes powers_ and get_feature_names, and
+    it keeps sparse input sparse.
+
+    Parameters: degree (int) 1 or 2
+    focus (list) column positions of the features to interact with all others
+    squares (boolean) whether to include squared terms at degree 2
+    include_bias (boolean) whether to include a column of ones
+    '''
+    def __init__(self, degree=2, focus=(), squares=True, include_bias=True):
+        self.degree = degree
+        self.focus = focus
+        self.squares = squares
+        self.include_bias = include_bias
+
+    def fit(self, X, y=None):
+        '''
+        Compute the exponents of each output feature.
+        Inputs: X (array or sparse matrix) features
+        Returns: self
+        '''
+        n_features = X.shape[1]
+        identity = np.eye(n_features, dtype=int)
+        powers = []
+
+        if self.include_bias:
+            powers.append(np.zeros(n_features, dtype=int))
+        powers.extend(identity)
+
+        if self.degree >= 2:
+            focus = list(self.focus)
+            for i in focus:
+                for j in range(n_features):
+                    # skip self-products and pairs already added from j
+                    if j != i and not (j in focus and focus.index(j) < focus.index(i)):
+                        powers.append(identity[i] + identity[j])
+            if self.squares:
+                powers.extend(2 * identity)
+
+        self.powers_ = np.array(powers)
+        self.n_input_features_ = n_features
+        self.n_output_features_ = len(powers)
+
+        return self
+
+    def transform(self, X):
+        '''
+        Build the selected products of features.
+        Inputs: X (array or sparse matrix) features
+        Returns: (array or sparse csr matrix) expanded features
+        '''
+        if sparse.issparse(X):
+            X = X.tocsc()
+            columns = []
+            for powers in self.powers_:
+                column = sparse.csc_matrix(np.ones((X.shape[0], 1)))
+                for i in np.flatnonzero(powers):
+                    column = column.multiply(X[:, [i]].power(powers[i]))
+                columns.append(sparse.csc_matrix(column))
+            return sparse.hstack(columns).tocsr()
+
+        X = np.asarray(X, dtype=float)
+        expanded = np.empty((X.shape[0], self.n_output_features_))
+        for col, powers in enumerate(self.powers_):
+            nonzero = np.flatnonzero(powers)
+            expanded[:, col] = np.prod(X[:, nonzero] ** powers[nonzero], axis=1)
+
+        return expanded
+
+    def get_feature_names(self, input_features=None):
+        '''
+        Names of the output features, in the format of PolynomialFeatures.
+        Inputs: input_features (list) names of the input features
+        Returns: (list) output feature names
+        '''
+        if input_features is None:
+            input_features = ['x{}'.format(i) for i in range(self.n_input_features_)]
+
+        names = []
+        for powers in self.powers_:
+            nonzero = np.flatnonzero(powers)
+            if len(nonzero) == 0:
+                names.append('1')
+                continue
+            names.append(' '.join(input_features[i] if powers[i] == 1 else
+                                  '{}^{}'.format(input_features[i], powers[i])
+                                  for i in nonzero))
+
+        return names
+
+
 def grid_search_cv(pipelines, params, scoring, cv, x_train, y_train):
     '''
     Runs cross validation on multiple sklearn Pipeline objects.
@@ -290,25 +520,39 @@ def format_keynames(params):
         
     return params
 
-def get_feature_importances(pipeline, mod, column_names):
+def get_feature_importances(pipeline, mod, column_names, x=None, y=None):
     '''
     Generate dataframe of feature importances with corresponding variable names.
+    Models without coefficients or impurity importances (e.g. histogram
+    gradient boosting) get permutation importances of the raw features,
+    which need x and y.
 
     Inputs: model (Pipeline) Pipeline object of machine learning model
     columns_names (list) list of column names in dataset. 
+    x (DataFrame) optional features for permutation importances
+    y (array) optional targets for permutation importances
 
     Returns: (DataFrame) df of feature importances with variable names
     '''
+    estimator = pipeline.named_steps[mod]
+    if not hasattr(estimator, 'coef_') and \
+       not hasattr(estimator, 'feature_importances_'):
+        if x is None or y is None:
+            raise ValueError('{} has no coefficients or feature importances; '
+                             'pass x and y for permutation importances'.format(mod))
+        df = get_permutation_importances(pipeline, x, y)
+        return df.rename(columns={'importance': 'coefficient'})
+
     tuples = []
     # Get feature names based on polynomial degree
     feature_names = pipeline.named_steps['pf'].get_feature_names(column_names)
 
     if mod == 'randomforest' or mod == 'decisiontree':
         for i, name in enumerate(feature_names):
-            tuples.append((name, pipeline.named_steps[mod].feature_importances_[i]))
+            tuples.append((name, estimator.feature_importances_[i]))
     else:
         for i, name in enumerate(feature_names):
-            tuples.append((name, pipeline.named_steps[mod].coef_[i]))
+            tuples.append((name, estimator.coef_[i]))
 
     # Sort feature importances in descending order and remove unimportant features
     sorted_by_coef = sorted(tuples, key=lambda tup: abs(tup[1]), reverse=True)
@@ -318,6 +562,88 @@ def get_feature_importances(pipeline, mod, column_names):
     return df
 
 
+def get_permutation_importances(pipeline, x, y, n_repeats=5, n_jobs=-1,
+                                random_state=0, cache_dir=IMPORTANCE_CACHE_DIR):
+    '''
+    Generate dataframe of model-agnostic permutation importances: the
+    increase in RMSE when a raw input column (before any polynomial
+    expansion) is shuffled. Unlike coefficients, these are comparable
+    across model families.
+
+    The baseline prediction is made once. All repeats for a column are
+    scored in a single batched predict call, and columns are spread across
+    a worker pool. Results are cached per hash of the model and data.
+
+    Inputs: pipeline (Pipeline) fitted Pipeline object
+    x (DataFrame) features
+    y (array) targets
+    n_repeats (int) number of shuffles per column
+    n_jobs (int) number of workers (-1 uses all cores)
+    random_state (int) seed for the shuffles
+    cache_dir (str) directory of cached results, or None to skip caching
+
+    Returns: (DataFrame) df of importances with variable names, sorted in
+    descending order
+    '''
+    filename = None
+    if cache_dir:
+        key = joblib.hash((pipeline, x, y, n_repeats, random_state))
+        filename = os.path.join(cache_dir,
+                                'permutation_importances_{}.pkl'.format(key))
+        if os.path.exists(filename):
+            return pd.read_pickle(filename)
+
+    column_names = list(x.columns) if hasattr(x, 'columns') \
+                   else list(range(x.shape[1]))
+    x = np.asarray(x)
+    y = np.ravel(y)
+
+    # Avoid nested parallelism and per-call logging inside the workers;
+    # the model is fitted, so it is copied rather than cloned
+    model = copy.deepcopy(pipeline)
+    params = model.get_params()
+    model.set_params(**{param: 1 for param in params
+                        if param.endswith('n_jobs')})
+    model.set_params(**{param: 0 for param in params
+                        if param.endswith('verbose')})
+
+    baseline = sqrt(mean_squared_error(y, model.predict(x)))
+    seeds = np.random.RandomState(random_state).randint(
+        np.iinfo(np.int32).max, size=x.shape[1])
+    scores = joblib.Parallel(n_jobs=n_jobs)(
+        joblib.delayed(_permuted_scores)(model, x, y, col, n_repeats, seed)
+        for col, seed in enumerate(seeds))
+    increases = np.array(scores) - baseline
+
+    df = pd.DataFrame({'label': column_names,
+                       'importance': increases.mean(axis=1),
+                       'importance_std': increases.std(axis=1)})
+    df = df.sort_values(by='importance', ascending=False) \
+           .reset_index(drop=True)
+
+    if filename:
+        os.makedirs(cache_dir, exist_ok=True)
+        df.to_pickle(filename)
+
+    return df
+
+
+def _permuted_scores(pipeline, x, y, col, n_repeats, seed):
+    '''
+    Shuffle one column n_repeats times and return the RMSE of each
+    repeat, predicting all repeats in one call.
+    '''
+    rng = np.random.RandomState(seed)
+    n_rows = x.shape[0]
+    x_repeated = np.tile(x, (n_repeats, 1))
+    for i in range(n_repeats):
+        x_repeated[i * n_rows:(i + 1) * n_rows, col] = rng.permutation(x[:, col])
+
+    errors = (pipeline.predict(x_repeated).reshape(n_repeats, n_rows) - y) ** 2
+
+    return np.sqrt(errors.mean(axis=1))
+
+
 def run_best_model(pipelines, mod, params, x_train, y_train, x_test, y_test):
     '''
     Runs the best model selected from the find_best_model function.
@@ -330,25 +656,59 @@ def run_best_model(pipelines, mod, params, x_train, y_train, x_test, y_test):
 
     Returns: (tuple)
     first element: (dict) results of running the model on entire dataset
-    second element: (DataFrame) nonzero feature importances of model sorted in
-    ascending order
+    second element: (DataFrame) permutation importances of the raw features
+    sorted in descending order
     third element: (Pipeline) the sklearn Pipeline for the best model
     '''
     best_model = pipelines[mod]
     best_model.set_params(**literal_eval(params))
     best_model.fit(x_train, y_train)
-    # Save the best model Pipeline object to a pkl file
-    pkl_filename = "pickle_files/best_model.pkl"
-    with open(pkl_filename, 'wb') as f:
-        pickle.dump(best_model, f)
     # Generate predictions and a dictionary of evaluation metrics
     predictions = best_model.predict(x_test)
+    rmse = sqrt(mean_squared_error(y_test, predictions))
+    # Save the best model Pipeline object, its test RMSE and the rows it
+    # was trained on to pkl files
+    save_best_model(best_model, mod, rmse, row_hashes(x_train))
     metrics = {}     
     metrics['Model'] = mod                                   
-    metrics['RMSE'] = '{0:.3f}'.format(sqrt(mean_squared_error(y_test, predictions))) 
+    metrics['RMSE'] = '{0:.3f}'.format(rmse) 
     metrics['R2'] = '{0:.3f}'.format(r2_score(y_test, predictions))
-    # Generate DataFrame of feature importances
-    df = get_feature_importances(best_model, mod, x_train.columns)
+    # Generate DataFrame of permutation importances on the test set
+    df = get_permutation_importances(best_model, x_test, y_test)
     # Convert params to dictionary
     params = format_keynames(params)
     return {**metrics, **params}, df, best_model
+
+
+def save_best_model(best_model, mod, rmse, train_rows=None):
+    '''
+    Save the best model Pipeline object and its test RMSE to pkl files. The
+    RMSE is used as the reference for drift checks when retraining
+    incrementally, and the training rows to find data the model never saw.
+
+    Inputs: best_model (Pipeline) fitted Pipeline object
+    mod (str) type of model corresponding to pipelines dictionary
+    rmse (float) RMSE of the model on the test set
+    train_rows (array) row_hashes of the training features
+
+    Returns: Nothing; files are written
+    '''
+    with open(BEST_MODEL_FILENAME, 'wb') as f:
+        pickle.dump(best_model, f)
+    with open(BEST_MODEL_METRICS_FILENAME, 'wb') as f:
+        pickle.dump({'Model': mod, 'RMSE': rmse, 'train_rows': train_rows}, f)
+
+
+def row_hashes(x):
+    '''
+    Hash each row of a features DataFrame, to recognize rows a model was
+    trained on. Imputed columns are left out so that hashes do not depend
+    on the imputed values.
+
+    Inputs: x (DataFrame) features
+
+    Returns: (array) one hash per row
+    '''
+    x = x.drop(columns=IMPUTED_COLUMNS, errors='ignore')
+
+    return pd.util.hash_pandas_object(x, index=False).values
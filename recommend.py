@@ -1,12 +1,23 @@
 '''
 Recommend tracts for intervention consideration or review
 '''
+import os
 import json
+import heapq
+import shutil
+import tempfile
+import joblib
+import numpy as np
 import pandas as pd
 import pipeline
+from scipy import sparse
+from sklearn.base import clone
 from sklearn.preprocessing import PolynomialFeatures
 
 
+MAX_TRANSIT_SCORE = 100
+
+
 def create_adjusted_features_df(features_df, tscore_num_to_add):
     '''
     Create new features dataframe, with transit score feature adjusted
@@ -25,8 +36,26 @@ def create_adjusted_features_df(features_df, tscore_num_to_add):
     return new_features
 
 
+def expand_features(features_df, num_poly=None, preprocessing=None):
+    '''
+    Apply the feature preprocessing the model was trained with: the fitted
+        steps of its pipeline before the estimator (e.g. scaling and
+        feature expansion) if given, otherwise a polynomial expansion of
+        degree num_poly, otherwise none
+    '''
+    if preprocessing is not None:
+        return pd.DataFrame(preprocessing.transform(features_df))
+
+    if num_poly:
+        poly = PolynomialFeatures(num_poly)
+        return pd.DataFrame(poly.fit_transform(features_df))
+
+    return features_df
+
+
 def recommend_tracts_for_action(df, model_obj, n_tracts=30, tscore_addition=10,
-                                num_poly=None):
+                                num_poly=None, transit_score_changes=None,
+                                preprocessing=None, n_top_features=0):
     '''
     Recommend top N tracts intervention consideration. These tracts
         are the ones that our model predicts will see the largest increase
@@ -42,6 +71,16 @@ def recommend_tracts_for_action(df, model_obj, n_tracts=30, tscore_addition=10,
         tscore_addition (integer): Number to add to transit score to allow
             model to predict new target
         num_poly (integer): polynomial expansion to apply to the data
+        transit_score_changes: Optional pandas series of simulated changes
+            in transit score indexed by 11-digit tract id (e.g. from
+            gtfs.score_changes), added to each tract's transit score
+            instead of tscore_addition; tracts without a change keep
+            their score
+        preprocessing: Optional fitted steps of the model's pipeline before
+            the estimator (e.g. Pipeline(best_model.steps[:-1])), used
+            instead of num_poly
+        n_top_features (integer): Number of top contributing features to
+            add to each tract (see attribute_predictions)
 
     Output:
         A pandas dataframe, where each row is a tract
@@ -50,12 +89,16 @@ def recommend_tracts_for_action(df, model_obj, n_tracts=30, tscore_addition=10,
     pipeline.impute(new_df, ['median_income'])
 
     features = new_df.drop(columns=['GEO_ID', 'commuting_ridership'], axis=1)
-    features_new_tscore = create_adjusted_features_df(features, tscore_addition)
+    if transit_score_changes is None:
+        features_new_tscore = create_adjusted_features_df(features, tscore_addition)
+    else:
+        changes = new_df['GEO_ID'].str[9:].map(transit_score_changes).fillna(0)
+        features_new_tscore = features.copy(deep=True)
+        features_new_tscore['transit_score'] = (features['transit_score'] +
+            changes).clip(0, MAX_TRANSIT_SCORE)
 
-    if num_poly:
-        poly = PolynomialFeatures(num_poly)
-        features = pd.DataFrame(poly.fit_transform(features))
-        features_new_tscore = pd.DataFrame(poly.fit_transform(features_new_tscore))
+    features = expand_features(features, num_poly, preprocessing)
+    features_new_tscore = expand_features(features_new_tscore, num_poly, preprocessing)
 
     current_state_predvals = model_obj.predict(features)
     new_tscore_predvals = model_obj.predict(features_new_tscore)
@@ -76,12 +119,21 @@ def recommend_tracts_for_action(df, model_obj, n_tracts=30, tscore_addition=10,
                     axis=1, inplace = True)
     results_df.insert(0, 'tract_id', tract_id)
     results_df.insert(2, 'pred_chg_commuting_ridership', pred_chg)
+    results_df = results_df.sort_values(by='pred_chg_commuting_ridership',
+                                        ascending=False).head(n_tracts)
 
-    return results_df.sort_values(by='pred_chg_commuting_ridership',
-                                  ascending=False).head(30)
+    if n_top_features:
+        # attribute over all tracts so linear terms are centered on the
+        # average tract, not on the recommended ones
+        contributions = attribute_predictions(df, model_obj, num_poly, preprocessing)
+        results_df = results_df.join(top_contributions(contributions,
+                                                       n_top_features))
 
+    return results_df
 
-def recommend_tracts_for_review(df, model_obj, n_tracts, num_poly=None):
+
+def recommend_tracts_for_review(df, model_obj, n_tracts, num_poly=None,
+                                preprocessing=None):
     '''
     Tracts with large negative gaps between model-predicted commuter
         transit ridership, and actual ridership
@@ -91,6 +143,9 @@ def recommend_tracts_for_review(df, model_obj, n_tracts, num_poly=None):
             columns are model features or is the model target
         model_obj: A fitted model object
         n_tracts (integer): Number of tracts to output
+        num_poly (integer): polynomial expansion to apply to the data
+        preprocessing: Optional fitted steps of the model's pipeline before
+            the estimator, used instead of num_poly
 
     Output:
         A pandas dataframe, where each row is a tract
@@ -101,9 +156,7 @@ def recommend_tracts_for_review(df, model_obj, n_tracts, num_poly=None):
 
     features = new_df.drop(columns=['GEO_ID', 'commuting_ridership'], axis=1)
 
-    if num_poly:
-        poly = PolynomialFeatures(num_poly)
-        features = pd.DataFrame(poly.fit_transform(features))
+    features = expand_features(features, num_poly, preprocessing)
 
     current_state_predvals = model_obj.predict(features)
     new_df['model_pred_ridership'] = current_state_predvals
@@ -122,4 +175,425 @@ def recommend_tracts_for_review(df, model_obj, n_tracts, num_poly=None):
     new_df.insert(3, 'model_pred_ridership', model_pred)
 
     return new_df.sort_values(by='diff_actual_and_model_pred',
-                                  ascending=True).head(30)
+                                  ascending=True).head(n_tracts)
+
+
+def bootstrap_recommendations(df, pipeline_obj, n_resamples=500, n_tracts=30,
+                              tscore_addition=10, alpha=0.05, n_jobs=-1,
+                              random_state=0):
+    '''
+    Bootstrap confidence intervals and rank stability for the tracts
+        recommended by recommend_tracts_for_action. The pipeline is refit
+        on n_resamples resamples of the tracts in a process pool, and each
+        refit scores the current and adjusted features of every tract in
+        one batched predict call.
+
+    The feature matrices are written once to a memory-mapped file which
+        all workers read from, so they are not copied to each process.
+
+    Inputs:
+        df: A pandas dataframe where each row is a census tract, and the
+            columns are model features or is the model target
+        pipeline_obj: An sklearn Pipeline (e.g. the one saved to
+            pickle_files/best_model.pkl) to refit on each resample
+        n_resamples (integer): Number of bootstrap resamples
+        n_tracts (integer): Number of tracts to output
+        tscore_addition (integer): Number to add to transit score to allow
+            model to predict new target
+        alpha (float): Intervals cover the central 1 - alpha share of
+            resamples
+        n_jobs (integer): Number of worker processes (-1 uses all cores)
+        random_state (integer): Seed for the resamples
+
+    Output:
+        A pandas dataframe, where each row is a tract, with the predicted
+            change, its interval, the interval of the tract's rank and the
+            share of resamples in which the tract is in the top n_tracts
+    '''
+    new_df = df.copy(deep=True)
+    pipeline.impute(new_df, ['median_income'])
+
+    features = new_df.drop(columns=['GEO_ID', 'commuting_ridership'], axis=1)
+    features_new_tscore = create_adjusted_features_df(features, tscore_addition)
+    n_rows = len(features)
+
+    # Current and adjusted features stacked so each refit predicts once
+    x_score = np.vstack([features.values, features_new_tscore.values])
+
+    # Avoid nested parallelism and per-fit logging inside the workers
+    model = clone(pipeline_obj)
+    params = model.get_params()
+    model.set_params(**{param: 1 for param in params
+                        if param.endswith('n_jobs')})
+    model.set_params(**{param: 0 for param in params
+                        if param.endswith('verbose')})
+
+    rng = np.random.RandomState(random_state)
+    seeds = rng.randint(np.iinfo(np.int32).max, size=n_resamples)
+    n_batches = min(n_resamples, joblib.cpu_count() * 4)
+
+    temp_folder = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(temp_folder, 'bootstrap_data.pkl')
+        joblib.dump((features.values, new_df['commuting_ridership'].values,
+                     x_score), filename)
+        x, y, x_score = joblib.load(filename, mmap_mode='r')
+
+        batches = joblib.Parallel(n_jobs=n_jobs)(
+            joblib.delayed(_bootstrap_batch)(model, x, y, x_score, batch)
+            for batch in np.array_split(seeds, n_batches))
+    finally:
+        shutil.rmtree(temp_folder, ignore_errors=True)
+
+    changes = np.vstack(batches)
+    # rank 1 is the largest predicted change within each resample
+    ranks = (-changes).argsort(axis=1).argsort(axis=1) + 1
+    quantiles = [100 * alpha / 2, 50, 100 * (1 - alpha / 2)]
+    chg_low, _, chg_high = np.percentile(changes, quantiles, axis=0)
+    rank_low, rank_median, rank_high = np.percentile(ranks, quantiles, axis=0)
+
+    point = pipeline_obj.predict(x_score)
+    results_df = pd.DataFrame({
+        'tract_id': new_df['GEO_ID'].str[9:].values,
+        'pred_chg_commuting_ridership': point[n_rows:] - point[:n_rows],
+        'pred_chg_lower': chg_low,
+        'pred_chg_upper': chg_high,
+        'median_rank': rank_median,
+        'rank_lower': rank_low,
+        'rank_upper': rank_high,
+        'share_in_top_n': (ranks <= n_tracts).mean(axis=0)})
+
+    return results_df.sort_values(by='pred_chg_commuting_ridership',
+                                  ascending=False).head(n_tracts)
+
+
+def _bootstrap_batch(model, x, y, x_score, seeds):
+    '''
+    Refits the model on one resample per seed and returns the predicted
+        change in ridership of every tract for each resample.
+    '''
+    n_rows = x.shape[0]
+    changes = np.empty((len(seeds), n_rows))
+
+    for i, seed in enumerate(seeds):
+        sample = np.random.RandomState(seed).randint(n_rows, size=n_rows)
+        fitted = clone(model).fit(x[sample], y[sample])
+        predvals = fitted.predict(x_score)
+        changes[i] = predvals[n_rows:] - predvals[:n_rows]
+
+    return changes
+
+
+def optimize_investment(df, model_obj, costs, budget, ids=None, weights=None,
+                        tscore_addition=10, spillover=0.5, num_poly=None,
+                        preprocessing=None, batch_size=50):
+    '''
+    Choose the set of tracts to invest in that maximizes the total
+        predicted increase in commuter transit ridership within a budget.
+        Investing in a tract raises its transit score by tscore_addition
+        and the transit score of each neighbouring tract by spillover
+        times its share of that tract's neighbours.
+
+    Tracts are picked with CELF: one greedy pass by predicted gain per
+        unit of cost and one by predicted gain, keeping the selection with
+        the larger total gain. Both passes use lazy evaluation: a tract's
+        cached gain is only recomputed when it reaches the top of the
+        queue, and stale gains are recomputed batch_size at a time in one
+        predict call. Only the invested tract and its neighbours are
+        rescored.
+
+    Inputs:
+        df: A pandas dataframe where each row is a census tract, and the
+            columns are model features or is the model target
+        model_obj: A fitted model object
+        costs: A pandas series of investment costs indexed by 11-digit
+            tract id; tracts without a cost are not considered
+        budget (float): Total budget
+        ids, weights: Optional output of spatial.load_weights; without
+            them there is no spillover to neighbours
+        tscore_addition (integer): Number to add to transit score of an
+            invested tract
+        spillover (float): Share of tscore_addition that reaches neighbours
+        num_poly (integer): polynomial expansion to apply to the data
+        preprocessing: Optional fitted steps of the model's pipeline before
+            the estimator, used instead of num_poly
+        batch_size (integer): Number of stale gains to recompute at once
+
+    Output:
+        A pandas dataframe of selected tracts in the order they were picked,
+            with cost, marginal predicted gain and cumulative totals
+    '''
+    new_df = df.copy(deep=True)
+    pipeline.impute(new_df, ['median_income'])
+
+    features = new_df.drop(columns=['GEO_ID', 'commuting_ridership'], axis=1)
+    tract_ids = new_df['GEO_ID'].str[9:].values
+    n_rows = len(features)
+    x_base = features.values.astype(float)
+    tscore_col = features.columns.get_loc('transit_score')
+    base_tscore = x_base[:, tscore_col]
+
+    # column i holds the transit score added to each tract by investing in i
+    if weights is None:
+        lifts = sparse.identity(n_rows, format='csc')
+    else:
+        positions = ids.get_indexer(tract_ids)
+        present = np.flatnonzero(positions >= 0)
+        select = sparse.csr_matrix((np.ones(len(present)),
+                                    (present, positions[present])),
+                                   shape=(n_rows, len(ids)))
+        neighbours = select.dot(weights).dot(select.T).tocsr()
+        row_sums = np.asarray(neighbours.sum(axis=1)).ravel()
+        row_sums[row_sums == 0] = 1
+        neighbours = sparse.diags(1 / row_sums).dot(neighbours)
+        lifts = (sparse.identity(n_rows) + spillover * neighbours).tocsc()
+    lifts = lifts * tscore_addition
+
+    def predict(x):
+        x_df = pd.DataFrame(x, columns=features.columns)
+        return model_obj.predict(expand_features(x_df, num_poly, preprocessing))
+
+    pred_base = predict(x_base)
+
+    def affected(i):
+        start, end = lifts.indptr[i], lifts.indptr[i + 1]
+        return lifts.indices[start:end], lifts.data[start:end]
+
+    def rescore(rows, added, boost):
+        x = x_base[rows]
+        x[:, tscore_col] = np.minimum(base_tscore[rows] + boost[rows] + added,
+                                      MAX_TRANSIT_SCORE)
+        return predict(x)
+
+    def batch_gains(candidates, boost, pred_current):
+        rows, added, groups = [], [], []
+        for group, i in enumerate(candidates):
+            i_rows, i_added = affected(i)
+            rows.append(i_rows)
+            added.append(i_added)
+            groups.append(np.full(len(i_rows), group))
+        rows = np.concatenate(rows)
+        changes = rescore(rows, np.concatenate(added), boost) - pred_current[rows]
+        return np.bincount(np.concatenate(groups), weights=changes,
+                           minlength=len(candidates))
+
+    tract_costs = pd.Series(tract_ids).map(costs).values.astype(float)
+    candidates = np.flatnonzero(~np.isnan(tract_costs) & (tract_costs > 0) &
+                                (tract_costs <= budget))
+    initial_gains = batch_gains(candidates, np.zeros(n_rows), pred_base) \
+                    if len(candidates) else []
+
+    # one lazy greedy pass, ranking tracts by gain per unit of cost if
+    # per_cost is True and by gain otherwise
+    def lazy_greedy(per_cost):
+        boost = np.zeros(n_rows)
+        pred_current = pred_base.copy()
+        scale = tract_costs if per_cost else np.ones(n_rows)
+        heap = [(-gain / scale[i], i, 0) for i, gain in zip(candidates, initial_gains)]
+        heapq.heapify(heap)
+
+        selected = []
+        spent = 0
+        while heap:
+            neg_priority, i, n_selected = heapq.heappop(heap)
+            if tract_costs[i] > budget - spent:
+                continue
+            if n_selected == len(selected):
+                if neg_priority >= 0:
+                    break
+                rows, added = affected(i)
+                pred_current[rows] = rescore(rows, added, boost)
+                boost[rows] += added
+                spent += tract_costs[i]
+                selected.append((tract_ids[i], tract_costs[i],
+                                 -neg_priority * scale[i]))
+                continue
+
+            # gain is stale; recompute it along with the next stale entries
+            stale = [i]
+            while heap and len(stale) < batch_size:
+                _, j, _ = heapq.heappop(heap)
+                if tract_costs[j] <= budget - spent:
+                    stale.append(j)
+            for j, gain in zip(stale, batch_gains(stale, boost, pred_current)):
+                heapq.heappush(heap, (-gain / scale[j], j, len(selected)))
+
+        return selected
+
+    # ranking by gain per unit of cost alone can be arbitrarily bad (e.g.
+    # a cheap tract crowding out an expensive one worth far more), so CELF
+    # keeps the better of the two passes
+    selected = max(lazy_greedy(True), lazy_greedy(False),
+                   key=lambda picks: sum(gain for _, _, gain in picks))
+
+    results_df = pd.DataFrame(selected, columns=['tract_id', 'cost',
+                                                 'pred_gain_commuting_ridership'])
+    results_df['cumulative_cost'] = results_df['cost'].cumsum()
+    results_df['cumulative_gain'] = results_df['pred_gain_commuting_ridership'].cumsum()
+
+    return results_df
+
+
+def attribute_predictions(df, model_obj, num_poly=None, preprocessing=None,
+                          n_jobs=-1):
+    '''
+    Per-tract attribution of the model's predicted ridership to the raw
+        features. Features are first transformed with the same steps
+        (scaling, expansion) the model was fit on. For linear models the
+        contribution of each expanded term is its coefficient times its
+        difference from the mean over tracts, computed for all tracts at
+        once. For decision trees, random forests and histogram gradient
+        boosting each split is credited with the change in node value
+        along the tract's decision path (averaged over forest trees,
+        summed over boosting iterations), computed in parallel over chunks
+        of tracts. Contributions of interaction and
+        squared terms are split between their raw features in proportion
+        to their exponents.
+
+    Inputs:
+        df: A pandas dataframe where each row is a census tract, and the
+            columns are model features or is the model target
+        model_obj: A fitted linear, decision tree, random forest or
+            histogram gradient boosting model
+        num_poly (integer): polynomial expansion to apply to the data
+        preprocessing: Optional fitted steps of the model's pipeline before
+            the estimator, used instead of num_poly
+        n_jobs (integer): Number of workers for tree models (-1 uses all
+            cores)
+
+    Output:
+        A pandas dataframe with the same index as df and one column of
+            contributions per raw feature
+    '''
+    new_df = df.copy(deep=True)
+    pipeline.impute(new_df, ['median_income'])
+    features = new_df.drop(columns=['GEO_ID', 'commuting_ridership'], axis=1)
+    expanded = np.asarray(expand_features(features, num_poly, preprocessing),
+                          dtype=float)
+
+    if preprocessing is not None and 'pf' in preprocessing.named_steps:
+        powers = preprocessing.named_steps['pf'].powers_
+    elif num_poly:
+        powers = PolynomialFeatures(num_poly).fit(features).powers_
+    else:
+        powers = np.eye(features.shape[1])
+    # share of each expanded term credited to each raw feature
+    degrees = powers.sum(axis=1, keepdims=True)
+    shares = powers / np.where(degrees == 0, 1, degrees)
+
+    if hasattr(model_obj, 'coef_'):
+        term_contributions = (expanded - expanded.mean(axis=0)) * \
+                             np.ravel(model_obj.coef_)
+    elif hasattr(model_obj, 'tree_') or hasattr(model_obj, 'estimators_'):
+        trees = getattr(model_obj, 'estimators_', [model_obj])
+        n_chunks = min(len(expanded), joblib.cpu_count())
+        chunks = joblib.Parallel(n_jobs=n_jobs)(
+            joblib.delayed(_tree_contributions)(trees, chunk)
+            for chunk in np.array_split(expanded, n_chunks))
+        term_contributions = np.vstack(chunks)
+    elif hasattr(model_obj, '_predictors'):
+        # histogram gradient boosting has no public tree structure
+        trees = [predictor for iteration in model_obj._predictors
+                 for predictor in iteration]
+        n_chunks = min(len(expanded), joblib.cpu_count())
+        chunks = joblib.Parallel(n_jobs=n_jobs)(
+            joblib.delayed(_boosting_contributions)(trees, chunk)
+            for chunk in np.array_split(expanded, n_chunks))
+        term_contributions = np.vstack(chunks)
+    else:
+        raise ValueError('Attributions are only available for linear, tree, '
+                         'random forest and gradient boosting models')
+
+    return pd.DataFrame(term_contributions.dot(shares), index=df.index,
+                        columns=features.columns)
+
+
+def _tree_contributions(trees, x):
+    '''
+    Path-dependent attribution of tree predictions to the features split
+        on, averaged over trees: one sparse product of the decision paths
+        with the per-node change in value.
+    '''
+    x = x.astype(np.float32)
+    contributions = np.zeros(x.shape)
+
+    for tree in trees:
+        structure = tree.tree_
+        values = structure.value[:, 0, 0]
+        internal = np.flatnonzero(structure.children_left != -1)
+        parents = np.full(structure.node_count, -1)
+        parents[structure.children_left[internal]] = internal
+        parents[structure.children_right[internal]] = internal
+
+        nodes = np.flatnonzero(parents >= 0)
+        node_deltas = sparse.csr_matrix(
+            (values[nodes] - values[parents[nodes]],
+             (nodes, structure.feature[parents[nodes]])),
+            shape=(structure.node_count, x.shape[1]))
+        contributions += tree.decision_path(x).dot(node_deltas).toarray()
+
+    return contributions / len(trees)
+
+
+def top_contributions(contributions, n_features=3):
+    '''
+    The features with the largest absolute contributions for each tract.
+
+    Inputs:
+        contributions: A pandas dataframe, output of attribute_predictions
+        n_features (integer): Number of features per tract
+
+    Output:
+        A pandas dataframe with the same index, with columns
+            top_feature_<i> and top_contribution_<i>
+    '''
+    values = contributions.values
+    order = np.argsort(-np.abs(values), axis=1)[:, :n_features]
+    names = contributions.columns.values[order]
+    top_values = np.take_along_axis(values, order, axis=1)
+
+    top_df = pd.DataFrame(index=contributions.index)
+    for i in range(order.shape[1]):
+        top_df['top_feature_{}'.format(i + 1)] = names[:, i]
+        top_df['top_contribution_{}'.format(i + 1)] = top_values[:, i]
+
+    return top_df
+
+
+def _boosting_contributions(predictors, x):
+    '''
+    Path-dependent attribution of histogram gradient boosting predictions,
+        summed over its trees. Internal node values are the count-weighted
+        means of their children, and all tracts are walked down each tree
+        one level at a time.
+    '''
+    contributions = np.zeros(x.shape)
+    rows = np.arange(x.shape[0])
+
+    for predictor in predictors:
+        nodes = predictor.nodes
+        values = nodes['value'].astype(float)
+        # children come after their parent, so fill in values bottom-up
+        for node in np.flatnonzero(~nodes['is_leaf'].astype(bool))[::-1]:
+            left, right = nodes['left'][node], nodes['right'][node]
+            counts = nodes['count'][left], nodes['count'][right]
+            values[node] = (counts[0] * values[left] + counts[1] * values[right]) \
+                           / max(counts[0] + counts[1], 1)
+
+        position = np.zeros(x.shape[0], dtype=int)
+        active = ~nodes['is_leaf'][position].astype(bool)
+        while active.any():
+            current = position[active]
+            features = nodes['feature_idx'][current]
+            x_values = x[rows[active], features]
+            go_left = np.where(np.isnan(x_values),
+                               nodes['missing_go_to_left'][current].astype(bool),
+                               x_values <= nodes['num_threshold'][current])
+            children = np.where(go_left, nodes['left'][current],
+                                nodes['right'][current])
+            np.add.at(contributions, (rows[active], features),
+                      values[children] - values[current])
+            position[active] = children
+            active = ~nodes['is_leaf'][position].astype(bool)
+
+    return contributions
@@ -0,0 +1,264 @@
+'''
+Spatial weights between census tracts and spatially lagged features
+'''
+import os
+import hashlib
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+from scipy import sparse
+from scipy.spatial import cKDTree
+import geometry
+
+WEIGHTS_DIR = 'pickle_files/weights'
+# TIGER polygons share exact vertices; rounding only guards against
+# floating point noise (7 decimal degrees is ~1cm)
+VERTEX_PRECISION = 7
+# radii (meters) of the job accessibility features and the distance over
+# which the weight of jobs in other tracts decays
+JOB_RADII = [1000, 5000, 10000]
+JOB_DECAY_DISTANCE = 2000
+
+
+def ring_vertices(geoms):
+    '''
+    Lists the rounded vertices of every ring of every polygon.
+
+    Inputs:
+        geoms (GeoSeries) polygons and multipolygons
+    Outputs:
+        (tuple of numpy arrays) position of the polygon each vertex belongs
+        to, its coordinates (n x 2), and the position of the ring it is on
+    '''
+    positions, coords, rings = [], [], []
+    ring_number = 0
+
+    for position, geom in enumerate(geoms):
+        polygons = geom.geoms if geom.geom_type == 'MultiPolygon' else [geom]
+        for polygon in polygons:
+            for ring in [polygon.exterior] + list(polygon.interiors):
+                ring_coords = np.round(np.asarray(ring.coords)[:, :2],
+                                       VERTEX_PRECISION)
+                coords.append(ring_coords)
+                positions.append(np.full(len(ring_coords), position))
+                rings.append(np.full(len(ring_coords), ring_number))
+                ring_number += 1
+
+    return np.concatenate(positions), np.vstack(coords), np.concatenate(rings)
+
+
+def contiguity_pairs(geoms, method='queen'):
+    '''
+    Finds pairs of contiguous polygons by hashing shared vertices (queen)
+    or shared edges (rook), instead of testing polygons against each other.
+    Runs in time linear in the number of vertices.
+
+    Inputs:
+        geoms (GeoSeries) polygons and multipolygons
+        method (str) 'queen' or 'rook'
+    Outputs:
+        (pandas DataFrame) columns i and j, positions of neighbouring polygons
+    '''
+    positions, coords, rings = ring_vertices(geoms)
+
+    if method == 'queen':
+        keys = pd.DataFrame({'i': positions, 'x': coords[:, 0],
+                             'y': coords[:, 1]})
+        on = ['x', 'y']
+    elif method == 'rook':
+        # consecutive vertices on the same ring form an edge
+        same_ring = rings[1:] == rings[:-1]
+        start, end = coords[:-1][same_ring], coords[1:][same_ring]
+        # orient each edge the same way regardless of ring direction
+        swap = (start[:, 0] > end[:, 0]) | \
+               ((start[:, 0] == end[:, 0]) & (start[:, 1] > end[:, 1]))
+        start[swap], end[swap] = end[swap], start[swap].copy()
+        keys = pd.DataFrame({'i': positions[1:][same_ring],
+                             'x1': start[:, 0], 'y1': start[:, 1],
+                             'x2': end[:, 0], 'y2': end[:, 1]})
+        on = ['x1', 'y1', 'x2', 'y2']
+    else:
+        raise ValueError("method must be 'queen' or 'rook'")
+
+    keys = keys.drop_duplicates()
+    pairs = keys.merge(keys.rename(columns={'i': 'j'}), on=on)
+    pairs = pairs.loc[pairs['i'] != pairs['j'], ['i', 'j']].drop_duplicates()
+
+    return pairs
+
+
+def knn_pairs(centroids, k):
+    '''
+    Finds the k nearest neighbours of every point with a KD-tree.
+
+    Inputs:
+        centroids (numpy array) n x 2 projected coordinates
+        k (int) number of neighbours
+    Outputs:
+        (pandas DataFrame) columns i and j, positions of neighbouring points
+    '''
+    _, neighbours = cKDTree(centroids).query(centroids, k=k + 1)
+    n = len(centroids)
+
+    pairs = pd.DataFrame({'i': np.repeat(np.arange(n), k),
+                          'j': neighbours[:, 1:].ravel()})
+
+    return pairs[pairs['i'] != pairs['j']]
+
+
+def build_weights(tracts_filepath, method='queen', k=8):
+    '''
+    Builds a binary sparse spatial weights matrix between tracts.
+
+    Inputs:
+        tracts_filepath (str)
+        method (str) 'queen', 'rook' or 'knn'
+        k (int) number of neighbours if method is 'knn'
+    Outputs:
+        (tuple) pandas Index of tract GEOIDs and scipy csr matrix whose rows
+        and columns follow that index
+    '''
+    if method == 'knn':
+        tracts = geometry.load_sidecar(tracts_filepath, ['GEOID'])
+        pairs = knn_pairs(tracts[['centroid_x', 'centroid_y']].values, k)
+    else:
+        tracts = gpd.read_file(tracts_filepath)
+        pairs = contiguity_pairs(tracts.geometry, method)
+
+    n = len(tracts)
+    weights = sparse.coo_matrix((np.ones(len(pairs)), (pairs['i'], pairs['j'])),
+                                shape=(n, n)).tocsr()
+
+    return pd.Index(tracts['GEOID'].values), weights
+
+
+def load_weights(tracts_filepath, method='queen', k=8, weights_dir=WEIGHTS_DIR):
+    '''
+    Loads the spatial weights matrix of a tract shapefile, building and
+    caching it first if it has not been built for the current checksum of
+    the file.
+
+    Inputs:
+        tracts_filepath (str)
+        method (str) 'queen', 'rook' or 'knn'
+        k (int) number of neighbours if method is 'knn'
+        weights_dir (str) directory of cached weights
+    Outputs:
+        (tuple) pandas Index of tract GEOIDs and scipy csr matrix
+    '''
+    stem = os.path.splitext(os.path.basename(tracts_filepath))[0]
+    name = method if method != 'knn' else 'knn{}'.format(k)
+    filename = os.path.join(weights_dir, '{}_{}_{}.pkl'.format(
+        stem, geometry.file_checksum(tracts_filepath)[:12], name))
+
+    if os.path.exists(filename):
+        return pd.read_pickle(filename)
+
+    ids, weights = build_weights(tracts_filepath, method, k)
+    os.makedirs(weights_dir, exist_ok=True)
+    pd.to_pickle((ids, weights), filename)
+
+    return ids, weights
+
+
+def add_spatial_lags(df, tract_ids, ids, weights, columns):
+    '''
+    Adds the spatial lag (mean over neighbouring tracts) of each column as
+    <column>_lag. The weights are restricted to the tracts in df and row
+    standardized, and missing values are left out of the mean, so all
+    columns are lagged with two sparse matrix products. Lags are never
+    missing, so they can be used as model features directly.
+
+    Inputs:
+        df (pandas DataFrame)
+        tract_ids (pandas Series) 11-digit tract id of each row of df
+        ids, weights: output of load_weights
+        columns (list) column names to lag
+    Outputs:
+        (pandas DataFrame) df with lagged columns added
+    '''
+    positions = ids.get_indexer(tract_ids)
+    present = positions >= 0
+    rows = weights[positions[present]][:, positions[present]]
+
+    values = df.loc[present, columns].values.astype(float)
+    missing = np.isnan(values)
+    totals = rows.dot(np.where(missing, 0, values))
+    counts = rows.dot((~missing).astype(float))
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        lags = totals / counts
+
+    for col_number, col in enumerate(columns):
+        lag_col = col + '_lag'
+        df[lag_col] = np.nan
+        df.loc[present, lag_col] = lags[:, col_number]
+        # tracts without neighbours with data (islands, tracts missing from
+        # the weights) take their own value, then the column median
+        df[lag_col] = df[lag_col].fillna(df[col]).fillna(df[col].median())
+
+    return df
+
+
+def centroid_neighbours(centroids, max_radius, cache_dir=WEIGHTS_DIR):
+    '''
+    Finds all pairs of distinct points within max_radius of each other with
+    a KD-tree, without building an all-pairs distance matrix. Pairs are
+    cached per set of points and radius.
+
+    Inputs:
+        centroids (numpy array) n x 2 projected coordinates
+        max_radius (float) in meters
+        cache_dir (str) directory of cached neighbour lists, or None to
+            skip caching
+    Outputs:
+        (numpy record array) fields i, j (positions) and v (distance)
+    '''
+    centroids = np.ascontiguousarray(centroids, dtype=float)
+    filename = None
+    if cache_dir:
+        key = hashlib.md5(centroids.tobytes()).hexdigest()[:12]
+        filename = os.path.join(cache_dir, 'neighbours_{}_{}.pkl'.format(
+            key, max_radius))
+        if os.path.exists(filename):
+            return pd.read_pickle(filename)
+
+    tree = cKDTree(centroids)
+    pairs = tree.sparse_distance_matrix(tree, max_radius, output_type='ndarray')
+    pairs = pairs[pairs['i'] != pairs['j']]
+
+    if filename:
+        os.makedirs(cache_dir, exist_ok=True)
+        pd.to_pickle(pairs, filename)
+
+    return pairs
+
+
+def add_job_accessibility(tracts, radii=JOB_RADII,
+                          decay_distance=JOB_DECAY_DISTANCE):
+    '''
+    Adds distance-decayed job counts within each radius of every tract as
+    jobs_within_<radius>m: the tract's own jobs plus the jobs of every
+    other tract whose centroid is within the radius, weighted by
+    exp(-distance / decay_distance).
+
+    Inputs:
+        tracts (pandas DataFrame) with num_jobs and projected centroid_x and
+            centroid_y columns (e.g. output of data_wrangling.tract_data)
+        radii (list) radii in meters
+        decay_distance (float) in meters
+    Outputs:
+        (pandas DataFrame) tracts with job accessibility columns added
+    '''
+    jobs = tracts['num_jobs'].values.astype(float)
+    pairs = centroid_neighbours(tracts[['centroid_x', 'centroid_y']].values,
+                                max(radii))
+    weighted_jobs = np.exp(-pairs['v'] / decay_distance) * jobs[pairs['j']]
+
+    for radius in radii:
+        within = pairs['v'] <= radius
+        tracts['jobs_within_{}m'.format(radius)] = jobs + np.bincount(
+            pairs['i'][within], weights=weighted_jobs[within],
+            minlength=len(tracts))
+
+    return tracts
@@ -0,0 +1,89 @@
+'''
+Run the stages of a build concurrently, respecting their dependencies
+'''
+import datetime
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, \
+                               FIRST_COMPLETED, wait
+
+
+def run_stages(stages, max_workers=None, verbose=True):
+    '''
+    Runs stages as soon as the stages they depend on have finished.
+    Network-bound stages should run in threads; CPU-bound stages (e.g.
+    geometry parsing) in processes, in which case the function and its
+    inputs must be picklable.
+
+    Inputs:
+        stages (dict) stage names mapped to tuples of (function, args,
+            dependencies, kind): the results of the dependencies (list of
+            stage names) are passed to the function first, followed by
+            args, and kind is 'thread' or 'process'
+        max_workers (int) maximum workers per pool
+        verbose (boolean) whether to print the critical path
+    Outputs:
+        (tuple) dictionary of results by stage name and the critical path
+        as a list of (stage name, duration) tuples
+    '''
+    pending = dict(stages)
+    running = {}
+    results = {}
+    timings = {}
+    start = datetime.datetime.now()
+
+    with ThreadPoolExecutor(max_workers) as threads, \
+         ProcessPoolExecutor(max_workers) as processes:
+        pools = {'thread': threads, 'process': processes}
+
+        while pending or running:
+            for name, (func, args, dependencies, kind) in list(pending.items()):
+                if all(dependency in results for dependency in dependencies):
+                    inputs = [results[dependency]
+                              for dependency in dependencies] + list(args)
+                    future = pools[kind].submit(func, *inputs)
+                    running[future] = (name, datetime.datetime.now())
+                    del pending[name]
+
+            if not running:
+                raise ValueError('Stages {} have unmet dependencies'
+                                 .format(list(pending)))
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name, started = running.pop(future)
+                results[name] = future.result()
+                timings[name] = (started, datetime.datetime.now())
+
+    path = critical_path(stages, timings)
+
+    if verbose:
+        print('Critical path:')
+        for name, duration in path:
+            print('  {}: {}'.format(name, duration))
+        print('Time Elapsed:', datetime.datetime.now() - start)
+
+    return results, path
+
+
+def critical_path(stages, timings):
+    '''
+    Finds the chain of stages that determined the total run time: starting
+    from the stage that finished last, repeatedly step to the dependency
+    that finished last.
+
+    Inputs:
+        stages (dict) see run_stages
+        timings (dict) stage names mapped to (start, end) datetimes
+    Outputs:
+        (list) (stage name, duration) tuples, in run order
+    '''
+    path = []
+    name = max(timings, key=lambda stage: timings[stage][1])
+
+    while name is not None:
+        started, ended = timings[name]
+        path.append((name, ended - started))
+        dependencies = stages[name][2]
+        name = max(dependencies, key=lambda stage: timings[stage][1]) \
+               if dependencies else None
+
+    return path[::-1]